@@ -0,0 +1,154 @@
+import asyncio
+import math
+import os
+from prometheus_client import Counter, Gauge
+from starlette.responses import JSONResponse
+
+# Longest a request waits for a free slot before it is shed
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", "10"))
+# Retry-After when there is no service time to estimate from yet
+RETRY_AFTER_SECONDS = int(os.getenv("RETRY_AFTER_SECONDS", "1"))
+# Weight of the newest request in the moving average of service times
+SERVICE_TIME_WEIGHT = 0.2
+
+coalesced_requests = Counter("coalesced_requests", "requests answered by a computation another request started",
+                             ["flight"])
+shed_requests = Counter("shed_requests", "requests turned away by admission control", ["endpoint", "reason"])
+admitted_requests_in_flight = Gauge("admitted_requests_in_flight", "requests holding an admission slot", ["endpoint"])
+admission_queue_depth = Gauge("admission_queue_depth", "requests waiting for an admission slot", ["endpoint"])
+
+
+class SingleFlight:
+    # Runs one computation per key at a time. Callers arriving while it runs await the
+    # same task instead of starting their own. A caller that goes away does not cancel
+    # the computation for the others.
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+
+    async def do(self, key, func, *args):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args))
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            coalesced_requests.labels(self.name).inc()
+        return await asyncio.shield(task)
+
+    ########## internals ##########
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Read the outcome so a failure nobody waited for is not logged as unretrieved
+        if not task.cancelled():
+            task.exception()
+
+
+class Overloaded(Exception):
+
+    def __init__(self, status_code, reason, retry_after):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class ConcurrencyLimiter:
+    # At most limit requests run at once, up to max_queue more wait for a slot. With
+    # the queue full a request is refused right away with 429, one that waited longer
+    # than queue_timeout gets 503. Both carry a Retry-After estimated from the queue
+    # depth and the average service time.
+
+    def __init__(self, endpoint, limit, max_queue, queue_timeout=ADMISSION_QUEUE_TIMEOUT_SECONDS):
+        self.endpoint = endpoint
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self.waiting = 0
+        self.service_time = None
+        # Created on first use, before 3.10 a semaphore binds to the loop current at creation
+        self._slots = None
+
+    def retry_after(self):
+        if self.service_time is None:
+            return RETRY_AFTER_SECONDS
+        return max(1, math.ceil((self.waiting + 1) * self.service_time / self.limit))
+
+    async def acquire(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.limit)
+        if self._slots.locked():
+            if self.waiting >= self.max_queue:
+                shed_requests.labels(self.endpoint, "queue_full").inc()
+                raise Overloaded(429, "too many requests waiting for this endpoint", self.retry_after())
+            self.waiting += 1
+            admission_queue_depth.labels(self.endpoint).inc()
+            try:
+                await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                shed_requests.labels(self.endpoint, "queue_timeout").inc()
+                raise Overloaded(503, "timed out waiting for a free slot", self.retry_after())
+            finally:
+                self.waiting -= 1
+                admission_queue_depth.labels(self.endpoint).dec()
+        else:
+            # A free slot is taken without suspending
+            await self._slots.acquire()
+        self.running += 1
+        admitted_requests_in_flight.labels(self.endpoint).inc()
+
+    def release(self, seconds):
+        self.running -= 1
+        admitted_requests_in_flight.labels(self.endpoint).dec()
+        if self.service_time is None:
+            self.service_time = seconds
+        else:
+            self.service_time += SERVICE_TIME_WEIGHT * (seconds - self.service_time)
+        self._slots.release()
+
+
+class AdmissionMiddleware:
+    # Puts the requests of each limited path through its limiter. The slot is held until
+    # the last byte is sent, so streamed responses count for as long as they stream. A
+    # handler can give it back earlier through scope["admission_release"], before a phase
+    # that should neither hold the slot nor count towards the service time.
+
+    def __init__(self, app, limiters=()):
+        self.app = app
+        self.limiters = {limiter.endpoint: limiter for limiter in limiters}
+
+    async def __call__(self, scope, receive, send):
+        limiter = self.limiters.get(scope["path"]) if scope["type"] == "http" else None
+        if limiter is None:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            await limiter.acquire()
+        except Overloaded as e:
+            # Never routed, labelled with the endpoint in the latency histogram all the same
+            scope["route_path"] = limiter.endpoint
+            response = JSONResponse({"detail": e.reason}, status_code=e.status_code,
+                                    headers={"Retry-After": str(e.retry_after)})
+            await response(scope, receive, send)
+            return
+
+        loop = asyncio.get_running_loop()
+        t1 = loop.time()
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                limiter.release(loop.time() - t1)
+
+        scope["admission_release"] = release
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            release()
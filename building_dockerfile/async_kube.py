@@ -0,0 +1,53 @@
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from kubernetes_asyncio import client, config
+
+# Upper bound on concurrent requests to the apiserver from the shared aiohttp session
+POOL_MAXSIZE = int(os.getenv("KUBE_POOL_MAXSIZE", "32"))
+# Connections of the separate client rollout watches use, each watch holds one for its whole wait
+WATCH_POOL_MAXSIZE = int(os.getenv("KUBE_WATCH_POOL_MAXSIZE", "16"))
+# Threads available to blocking work (sync Kubernetes client, psycopg2, ...)
+BLOCKING_WORKERS = int(os.getenv("BLOCKING_WORKERS", "16"))
+
+_blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="blocking")
+
+
+async def run_blocking(func, *args, **kwargs):
+    # Runs a synchronous call on the bounded pool so the event loop keeps serving requests.
+    # The call runs in a copy of the caller's context, so its spans join the caller's trace.
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_blocking_executor, functools.partial(context.run, func, *args, **kwargs))
+
+
+class AsyncKubeClients:
+    # asyncio counterpart of kube_clients.KubeClients. The ApiClient owns a single
+    # aiohttp session, so every coroutine shares its connection pool.
+
+    def __init__(self, in_cluster, pool_maxsize=POOL_MAXSIZE, context=None):
+        self.in_cluster = in_cluster
+        self.pool_maxsize = pool_maxsize
+        self.context = context
+        self.api_client = None
+        self.apps_v1 = None
+        self.core_v1 = None
+
+    async def start(self):
+        configuration = client.Configuration()
+        if self.in_cluster:
+            config.load_incluster_config(client_configuration=configuration)
+        else:
+            await config.load_kube_config(context=self.context, client_configuration=configuration,
+                                          persist_config=False)
+        configuration.connection_pool_maxsize = self.pool_maxsize
+
+        self.api_client = client.ApiClient(configuration)
+        self.apps_v1 = client.AppsV1Api(self.api_client)
+        self.core_v1 = client.CoreV1Api(self.api_client)
+
+    async def close(self):
+        if self.api_client is not None:
+            await self.api_client.close()
@@ -0,0 +1,364 @@
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Resources the service reads or writes, by plural name
+RESOURCES = {
+    "deployments": ("apps/v1", "Deployment"),
+    "statefulsets": ("apps/v1", "StatefulSet"),
+    "pods": ("v1", "Pod"),
+    "services": ("v1", "Service"),
+    "secrets": ("v1", "Secret"),
+    "configmaps": ("v1", "ConfigMap"),
+    "persistentvolumeclaims": ("v1", "PersistentVolumeClaim"),
+    "persistentvolumes": ("v1", "PersistentVolume"),
+}
+
+# Longest time a watch is held open, informers simply open a new one afterwards
+MAX_WATCH_SECONDS = 30
+# Events kept per resource so a watch can resume from the resourceVersion of its list
+WATCH_HISTORY = 10000
+
+
+def seed_deployment(name, replicas):
+    return {
+        "apiVersion": "apps/v1",
+        "kind": "Deployment",
+        "metadata": {"name": name, "namespace": "default", "labels": {"app": name}, "generation": 1},
+        "spec": {
+            "replicas": replicas,
+            "selector": {"matchLabels": {"app": name}},
+            "template": {"metadata": {"labels": {"app": name}},
+                         "spec": {"containers": [{"name": name, "image": "nginx:1.25"}]}}
+        },
+        "status": {"observedGeneration": 1, "replicas": replicas, "updatedReplicas": replicas,
+                   "readyReplicas": replicas, "availableReplicas": replicas}
+    }
+
+
+def seed_pod(name, app, index):
+    return {
+        "apiVersion": "v1",
+        "kind": "Pod",
+        "metadata": {"name": name, "namespace": "default", "labels": {"app": app}},
+        "spec": {"containers": [{"name": app, "image": "nginx:1.25"}], "nodeName": f"node-{index % 8}"},
+        "status": {"phase": "Running", "startTime": "2024-01-01T00:00:00Z",
+                   "hostIP": f"10.0.0.{index % 8 + 1}", "podIP": f"10.244.{index // 250}.{index % 250 + 1}"}
+    }
+
+
+def mark_ready(obj):
+    # Workloads written through the fake are reported as rolled out right away
+    spec = obj.get("spec", {})
+    replicas = spec.get("replicas", 1)
+    obj["status"] = {"observedGeneration": obj["metadata"]["generation"], "replicas": replicas,
+                     "updatedReplicas": replicas, "readyReplicas": replicas, "availableReplicas": replicas,
+                     "currentRevision": "r1", "updateRevision": "r1"}
+
+
+def label_selector_matches(selector, labels):
+    for requirement in selector.split(","):
+        key, _, value = requirement.partition("=")
+        if labels.get(key) != value:
+            return False
+    return True
+
+
+def selectors_match(query, obj):
+    # Only the metadata.name field selector is supported, it is the one the service uses
+    if "labelSelector" in query and not label_selector_matches(query["labelSelector"],
+                                                               obj["metadata"].get("labels") or {}):
+        return False
+    if "fieldSelector" in query and obj["metadata"]["name"] != query["fieldSelector"].partition("=")[2]:
+        return False
+    return True
+
+
+class FakeApiServer:
+    # Minimal in-memory Kubernetes API server. It serves lists with paging, label and
+    # field selectors, gets, creates, server-side applies, deletes and watches, and
+    # counts every call so a load test can report apiserver calls per request. Every
+    # write is sent to the open watches of its resource, like informers expect.
+
+    def __init__(self, deployments=100, pods_per_deployment=5, host="127.0.0.1", port=0):
+        self.objects = {plural: {} for plural in RESOURCES}
+        self.resource_version = 1
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        # plural -> recent (resourceVersion, event), and the queues of the open watches
+        self.history = {plural: deque(maxlen=WATCH_HISTORY) for plural in RESOURCES}
+        self.watchers = {plural: set() for plural in RESOURCES}
+        index = 0
+        for i in range(deployments):
+            name = f"app-{i}"
+            self._store("deployments", seed_deployment(name, pods_per_deployment))
+            for j in range(pods_per_deployment):
+                self._store("pods", seed_pod(f"{name}-{j}", name, index))
+                index += 1
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+        self.kubeconfig = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-apiserver", daemon=True)
+        self.thread.start()
+        self.kubeconfig = self.write_kubeconfig()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        self.server.shutdown()
+        self.server.server_close()
+        if self.kubeconfig:
+            os.unlink(self.kubeconfig)
+
+    def write_kubeconfig(self):
+        kubeconfig = {
+            "apiVersion": "v1",
+            "kind": "Config",
+            "clusters": [{"name": "fake", "cluster": {"server": self.url}}],
+            "users": [{"name": "fake", "user": {"token": "fake"}}],
+            "contexts": [{"name": "fake", "context": {"cluster": "fake", "user": "fake"}}],
+            "current-context": "fake"
+        }
+        fd, path = tempfile.mkstemp(prefix="fake-kubeconfig-", suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(kubeconfig, f)
+        return path
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls.clear()
+
+    def call_count(self, include_watches=False):
+        with self.lock:
+            return sum(count for (method, _), count in self.calls.items() if include_watches or method != "WATCH")
+
+    ########################################## internals ##########################################
+
+    # Called with the lock held, or before the server is started
+
+    def _store(self, plural, obj):
+        self.resource_version += 1
+        obj["metadata"]["resourceVersion"] = str(self.resource_version)
+        name = obj["metadata"]["name"]
+        event_type = "MODIFIED" if name in self.objects[plural] else "ADDED"
+        self.objects[plural][name] = obj
+        self._publish(plural, event_type, obj)
+        return obj
+
+    def _remove(self, plural, name):
+        obj = self.objects[plural].pop(name, None)
+        if obj is not None:
+            self.resource_version += 1
+            obj = {**obj, "metadata": {**obj["metadata"], "resourceVersion": str(self.resource_version)}}
+            self._publish(plural, "DELETED", obj)
+        return obj
+
+    def _publish(self, plural, event_type, obj):
+        event = {"type": event_type, "object": obj}
+        self.history[plural].append((self.resource_version, event))
+        for watcher in self.watchers[plural]:
+            watcher.put(event)
+
+    def _subscribe(self, plural, resource_version):
+        # Returns the watcher queue with the events after resource_version already in it,
+        # or None if they are no longer kept
+        watcher = queue.Queue()
+        with self.lock:
+            history = self.history[plural]
+            if resource_version is not None:
+                if len(history) == history.maxlen and history[0][0] > resource_version + 1:
+                    return None
+                for version, event in history:
+                    if version > resource_version:
+                        watcher.put(event)
+            self.watchers[plural].add(watcher)
+        return watcher
+
+    def _unsubscribe(self, plural, watcher):
+        with self.lock:
+            self.watchers[plural].discard(watcher)
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, obj, code=200):
+                body = json.dumps(obj).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _status(self, code, reason):
+                self._send({"kind": "Status", "apiVersion": "v1", "status": "Failure", "code": code, "reason": reason}, code)
+
+            def _body(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(length)) if length else {}
+
+            def _route(self):
+                # Returns (plural, name, query) for /api/v1/... and /apis/<group>/<version>/...
+                url = urlparse(self.path)
+                parts = [part for part in url.path.split("/") if part]
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                if parts and parts[-1] in RESOURCES:
+                    return parts[-1], None, query
+                if len(parts) >= 2 and parts[-2] in RESOURCES:
+                    return parts[-2], parts[-1], query
+                return None, None, query
+
+            def _count(self, method, plural):
+                with fake.lock:
+                    fake.calls[(method, plural)] += 1
+
+            def do_GET(self):
+                plural, name, query = self._route()
+                if plural is None:
+                    return self._status(404, "NotFound")
+                if query.get("watch") in ("true", "True", "1"):
+                    self._count("WATCH", plural)
+                    return self._watch(plural, query)
+                self._count("GET", plural)
+                with fake.lock:
+                    if name is not None:
+                        obj = fake.objects[plural].get(name)
+                        return self._send(obj) if obj is not None else self._status(404, "NotFound")
+                    items = list(fake.objects[plural].values())
+                    resource_version = str(fake.resource_version)
+                items = [obj for obj in items if selectors_match(query, obj)]
+                start = int(query.get("continue") or 0)
+                limit = int(query.get("limit") or len(items) or 1)
+                page = items[start:start + limit]
+                _continue = str(start + limit) if start + limit < len(items) else None
+                api_version, kind = RESOURCES[plural]
+                self._send({"apiVersion": api_version, "kind": f"{kind}List",
+                            "metadata": {"resourceVersion": resource_version, "continue": _continue},
+                            "items": page})
+
+            def _event(self, event):
+                # One chunk per event, clients stream chunked bodies line by line
+                data = (json.dumps(event) + "\n").encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+
+            def _watch(self, plural, query):
+                # Without a resourceVersion the watch starts with the matching objects as
+                # ADDED events, with one it resumes after that version. Writes are then
+                # sent as they happen until the timeout.
+                resource_version = int(query["resourceVersion"]) if query.get("resourceVersion") else None
+                watcher = fake._subscribe(plural, resource_version)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+                if watcher is None:
+                    self._event({"type": "ERROR", "object": {"kind": "Status", "apiVersion": "v1",
+                                                             "status": "Failure", "code": 410, "reason": "Expired"}})
+                    return self.wfile.write(b"0\r\n\r\n")
+                deadline = time.monotonic() + min(float(query.get("timeoutSeconds") or MAX_WATCH_SECONDS),
+                                                  MAX_WATCH_SECONDS)
+                try:
+                    if resource_version is None:
+                        with fake.lock:
+                            initial = [obj for obj in fake.objects[plural].values() if selectors_match(query, obj)]
+                        for obj in initial:
+                            self._event({"type": "ADDED", "object": obj})
+                    while not fake.stopping.is_set():
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        try:
+                            event = watcher.get(timeout=min(remaining, 1))
+                        except queue.Empty:
+                            continue
+                        if selectors_match(query, event["object"]):
+                            self._event(event)
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    fake._unsubscribe(plural, watcher)
+
+            def do_POST(self):
+                plural, _, _ = self._route()
+                if plural is None:
+                    return self._status(404, "NotFound")
+                self._count("POST", plural)
+                obj = self._body()
+                obj.setdefault("metadata", {}).setdefault("namespace", "default")
+                with fake.lock:
+                    if obj["metadata"]["name"] in fake.objects[plural]:
+                        return self._status(409, "AlreadyExists")
+                    obj["metadata"]["generation"] = 1
+                    if plural in ("deployments", "statefulsets"):
+                        mark_ready(obj)
+                    fake._store(plural, obj)
+                self._send(obj, 201)
+
+            def do_PATCH(self):
+                # Only server-side apply is used, the applied object replaces the stored one
+                plural, name, _ = self._route()
+                if plural is None or name is None:
+                    return self._status(404, "NotFound")
+                self._count("PATCH", plural)
+                obj = self._body()
+                obj.setdefault("metadata", {}).setdefault("namespace", "default")
+                with fake.lock:
+                    old = fake.objects[plural].get(name)
+                    obj["metadata"]["generation"] = old["metadata"].get("generation", 1) + 1 if old else 1
+                    if plural in ("deployments", "statefulsets"):
+                        mark_ready(obj)
+                    fake._store(plural, obj)
+                self._send(obj)
+
+            def do_DELETE(self):
+                plural, name, _ = self._route()
+                if plural is None or name is None:
+                    return self._status(404, "NotFound")
+                self._count("DELETE", plural)
+                with fake.lock:
+                    obj = fake._remove(plural, name)
+                if obj is None:
+                    return self._status(404, "NotFound")
+                self._send({"kind": "Status", "apiVersion": "v1", "status": "Success"})
+
+        return Handler
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve a seeded fake Kubernetes API")
+    parser.add_argument("--deployments", type=int, default=100)
+    parser.add_argument("--pods-per-deployment", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8001)
+    args = parser.parse_args()
+    fake = FakeApiServer(args.deployments, args.pods_per_deployment, port=args.port).start()
+    print(f"fake apiserver on {fake.url}, kubeconfig {fake.kubeconfig}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
@@ -0,0 +1,306 @@
+# Load test of the API. Starts a seeded fake Kubernetes API server, runs the app against
+# it with in-memory stand-ins for Postgres, drives each endpoint at a fixed concurrency
+# and reports requests per second, latency percentiles and apiserver calls per request.
+#
+#   python benchmarks/loadtest.py --deployments 500 --pods-per-deployment 10 --concurrency 32
+#   python benchmarks/loadtest.py --live --output live.json
+#   python benchmarks/loadtest.py --live --baseline live.json    # exits 1 on a regression
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+# The service modules are imported the same way the app imports them
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+import aiohttp
+from fake_apiserver import FakeApiServer
+
+SCENARIOS = [
+    "status_all", "status_all_stream", "status_one", "generate_deployment", "generate_batch",
+    "deploy_postgresql", "job_status", "health", "manifests", "metrics"
+]
+
+BATCH_SIZE = 10
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def full_config(appname, revision):
+    return {
+        "deployment": {"appname": appname, "replicas": 2, "imageaddress": "nginx", "imagetag": "1.25",
+                       "container_port": 80, "memory_request": "64Mi", "cpu_request": "100m",
+                       "env_vars": {"REVISION": str(revision)}, "secret_name": f"{appname}-secret"},
+        "service": {"name": f"{appname}-svc", "app": appname, "external_access": "ClusterIP", "node_port": 30000},
+        "secret": {"name": f"{appname}-secret", "data": {"password": "hunter2"}}
+    }
+
+
+########################################## stand-ins ##########################################
+
+class InMemoryHealthDB:
+    # Answers health lookups for every seeded app the way the health_status table would
+
+    def __init__(self, deployments):
+        self.rows = {f"app-{i}": [{"app_name": f"app-{i}", "success_count": 100, "failure_count": 0,
+                                   "last_success": "2024-01-01T00:00:00+00:00", "last_failure": None}]
+                     for i in range(deployments)}
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def fetch_health_status(self, app_name):
+        return self.rows.get(app_name, [])
+
+
+def in_memory_job_queue(handlers):
+    # The job queue with its Postgres table replaced by a dict
+    from provisioning_jobs import JobQueue
+
+    class InMemoryJobQueue(JobQueue):
+
+        def __init__(self, handlers):
+            super().__init__(handlers)
+            self.rows = {}
+
+        async def start(self):
+            self._start_workers()
+
+        async def stop(self):
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+        async def submit(self, kind, params):
+            job = {"id": uuid.uuid4(), "kind": kind, "params": params, "status": "queued", "steps": {},
+                   "result": None, "error": None}
+            self.rows[job["id"]] = job
+            self._waiters[job["id"]] = asyncio.get_running_loop().create_future()
+            self._enqueue(job)
+            return dict(job)
+
+        async def get(self, job_id):
+            job = self.rows.get(job_id)
+            return {**job, "steps": dict(job["steps"])} if job is not None else None
+
+        async def _set_status(self, job_id, status, result=None, error=None):
+            self.rows[job_id].update(status=status, result=result, error=error)
+
+        async def _set_step(self, job_id, step, state):
+            self.rows[job_id]["steps"][step] = state
+
+        def pending(self):
+            return sum(1 for job in self.rows.values() if job["status"] in ("queued", "running"))
+
+    return InMemoryJobQueue(handlers)
+
+
+########################################## app ##########################################
+
+def start_app(fake, args):
+    # The app reads its configuration at import time, so the environment is set first
+    os.environ["KUBECONFIG"] = fake.kubeconfig
+    os.environ.setdefault("TRACE_FILE", os.path.join(tempfile.gettempdir(), "kaas-loadtest-traces.jsonl"))
+    import uvicorn
+    import service1
+    from health_cache import HealthCache
+
+    service1.db_pool = InMemoryHealthDB(args.deployments)
+    service1.master_db_pool = InMemoryHealthDB(args.deployments)
+    # Without LISTEN the cache reads through, every lookup reaches the stand-in
+    service1.health_cache = HealthCache()
+    service1.health_cache.start = lambda: None
+    service1.jobs = in_memory_job_queue({"postgresql": service1.run_postgresql_job})
+    if args.live:
+        service1.caches_synced = lambda: False
+
+    server = uvicorn.Server(uvicorn.Config(service1.app, host="127.0.0.1", port=args.port, log_level="warning"))
+    thread = threading.Thread(target=server.run, name="app", daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    if not args.live:
+        deadline = time.time() + 30
+        while not service1.caches_synced() and time.time() < deadline:
+            time.sleep(0.05)
+    return service1, server, thread
+
+
+########################################## driver ##########################################
+
+def scenario_request(name, i, args, context):
+    # Returns (method, path, json body) of the i-th request of a scenario
+    app = f"app-{i % args.deployments}"
+    if name == "status_all":
+        return "GET", "/receiving_status_of_all_deployments", None
+    if name == "status_all_stream":
+        return "GET", "/receiving_status_of_all_deployments?stream=true", None
+    if name == "status_one":
+        return "POST", f"/receiving_status_of_specific_deployment?appname={app}", None
+    if name == "generate_deployment":
+        return "POST", "/generate-deployment/", full_config(f"bench-{i % 50}", i)
+    if name == "generate_batch":
+        configs = [full_config(f"batch-{i}-{j}", i) for j in range(BATCH_SIZE)]
+        for j, config in enumerate(configs):
+            config["service"]["node_port"] = 30000 + j
+        return "POST", "/generate-deployments/batch", configs
+    if name == "deploy_postgresql":
+        return "POST", f"/deploy-postgresql?appname=pg-{i}&cpu=500m&memory=512Mi&external=false", None
+    if name == "job_status":
+        return "GET", f"/deploy-postgresql/jobs/{context['job_id']}", None
+    if name == "health":
+        return "GET", f"/health/{app}", None
+    if name == "manifests":
+        return "GET", "/manifests/bench-0", None
+    if name == "metrics":
+        return "GET", "/metrics", None
+    raise ValueError(f"unknown scenario {name}")
+
+
+async def run_scenario(session, base_url, name, args, context):
+    latencies = []
+    errors = 0
+    next_index = 0
+
+    async def worker():
+        nonlocal next_index, errors
+        while next_index < args.requests:
+            i = next_index
+            next_index += 1
+            method, path, body = scenario_request(name, i, args, context)
+            t1 = time.perf_counter()
+            try:
+                async with session.request(method, base_url + path, json=body) as response:
+                    await response.read()
+                    if response.status >= 400:
+                        errors += 1
+            except aiohttp.ClientError:
+                errors += 1
+            latencies.append(time.perf_counter() - t1)
+
+    t1 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    return time.perf_counter() - t1, sorted(latencies), errors
+
+
+async def drive(base_url, service1, fake, args):
+    results = []
+    context = {}
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        # A job to look up for the job scenario
+        async with session.post(base_url + "/deploy-postgresql?appname=pg-seed&cpu=1&memory=1Gi&external=false") as response:
+            context["job_id"] = (await response.json())["job_id"]
+
+        for index, name in enumerate(args.scenarios):
+            while service1.jobs.pending():
+                await asyncio.sleep(0.05)
+            if name == "manifests":
+                # Recorded right before, earlier scenarios record enough apps to push it out
+                # of the manifest store. A config not applied yet, or it would be a no-op.
+                config = full_config("bench-0", -1 - index)
+                async with session.post(base_url + "/generate-deployment/", json=config) as response:
+                    await response.read()
+            fake.reset_calls()
+            seconds, latencies, errors = await run_scenario(session, base_url, name, args, context)
+            # Provisioning jobs keep calling the apiserver after their 202, count those too
+            while service1.jobs.pending():
+                await asyncio.sleep(0.05)
+            results.append({
+                "scenario": name,
+                "requests": len(latencies),
+                "errors": errors,
+                "rps": round(len(latencies) / seconds, 1),
+                "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+                "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+                "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+                "apiserver_calls_per_request": round(fake.call_count() / len(latencies), 2)
+            })
+    return results
+
+
+def print_report(results, args):
+    mode = "live apiserver reads" if args.live else "informer cache"
+    print(f"{args.deployments} deployments x {args.pods_per_deployment} pods, "
+          f"{args.requests} requests per scenario at concurrency {args.concurrency}, {mode}")
+    header = f"{'scenario':<22}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'api/req':>10}{'errors':>8}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['scenario']:<22}{r['rps']:>10}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}"
+              f"{r['apiserver_calls_per_request']:>10}{r['errors']:>8}")
+
+
+def compare(results, baseline_path, tolerance):
+    # Flags scenarios whose p95 or apiserver calls per request grew past the tolerance
+    with open(baseline_path) as f:
+        baseline = {r["scenario"]: r for r in json.load(f)["results"]}
+    regressions = []
+    for r in results:
+        before = baseline.get(r["scenario"])
+        if before is None:
+            continue
+        if r["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{r['scenario']}: p95 {before['p95_ms']} -> {r['p95_ms']} ms")
+        if r["apiserver_calls_per_request"] > before["apiserver_calls_per_request"] + 0.01:
+            regressions.append(f"{r['scenario']}: apiserver calls/request "
+                               f"{before['apiserver_calls_per_request']} -> {r['apiserver_calls_per_request']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the API against a fake Kubernetes API server")
+    parser.add_argument("--deployments", type=int, default=200)
+    parser.add_argument("--pods-per-deployment", type=int, default=5)
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated, default all")
+    parser.add_argument("--live", action="store_true", help="bypass the informer cache and read the apiserver")
+    parser.add_argument("--port", type=int, default=7101)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p95 growth against the baseline")
+    args = parser.parse_args()
+    args.scenarios = [name for name in args.scenarios.split(",") if name]
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name}, choose from {', '.join(SCENARIOS)}")
+
+    fake = FakeApiServer(args.deployments, args.pods_per_deployment).start()
+    service1, server, thread = start_app(fake, args)
+    try:
+        results = asyncio.run(drive(f"http://127.0.0.1:{args.port}", service1, fake, args))
+    finally:
+        server.should_exit = True
+        thread.join(10)
+        fake.stop()
+
+    print_report(results, args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+                       "results": results}, f, indent=2)
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
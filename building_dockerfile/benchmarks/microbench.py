@@ -0,0 +1,209 @@
+# Microbenchmarks of the CPU-bound code paths: building manifest dicts, YAML and JSON
+# encoding, secret base64 encoding and building pod status dicts. Results are compared
+# with a stored baseline, YAML emitter alternatives are measured side by side.
+#
+#   python benchmarks/microbench.py                       # compare with the stored baseline
+#   python benchmarks/microbench.py --save                # store this run as the new baseline
+#   python benchmarks/microbench.py --filter yaml --env-vars 10000
+import argparse
+import base64
+import datetime
+import json
+import os
+import platform
+import sys
+import timeit
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+import orjson
+import yaml
+from kubernetes import client
+from deployment_status import (build_status, group_pods, grouped_statuses, lean_pod, parse_fields, pod_summary,
+                               project_status)
+from fake_apiserver import seed_pod
+from manifests import ManifestRenderer, config_hash, render_manifests
+
+BASELINE_FILE = os.path.join(BENCHMARKS_DIR, "baselines", "microbench.json")
+REPEAT = 5
+
+
+class Section:
+    # Attribute access like the pydantic sections of FullConfig
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+class BenchConfig:
+    # Same shape as FullConfig in service1, which cannot be imported without a cluster
+
+    def __init__(self, env_vars, secret_keys):
+        self.deployment = Section(appname="bench", replicas=3, imageaddress="registry.local/bench", imagetag="1.0",
+                                  container_port=8080, memory_request="128Mi", cpu_request="250m",
+                                  env_vars={f"ENV_{i}": f"value-{i}" for i in range(env_vars)},
+                                  secret_name="bench-secret")
+        self.service = Section(name="bench-svc", app="bench", external_access="NodePort", node_port=30080)
+        self.secret = Section(name="bench-secret", data={f"key_{i}": "s3cr3t-" * 8 for i in range(secret_keys)})
+
+    def model_dump(self):
+        return {section: dict(vars(getattr(self, section))) for section in ("deployment", "service", "secret")}
+
+
+def make_deployments(count):
+    return [client.V1Deployment(
+        metadata=client.V1ObjectMeta(name=f"app-{i}", namespace="default", labels={"app": f"app-{i}"}),
+        spec=client.V1DeploymentSpec(replicas=3, selector=client.V1LabelSelector(match_labels={"app": f"app-{i}"}),
+                                     template=client.V1PodTemplateSpec()),
+        status=client.V1DeploymentStatus(available_replicas=3)
+    ) for i in range(count)]
+
+
+def make_pods(count, deployments):
+    started = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    return [client.V1Pod(
+        metadata=client.V1ObjectMeta(name=f"pod-{i}", namespace="default", labels={"app": f"app-{i % deployments}"}),
+        spec=client.V1PodSpec(containers=[], node_name=f"node-{i % 16}"),
+        status=client.V1PodStatus(phase="Running", start_time=started, host_ip=f"10.0.0.{i % 16 + 1}",
+                                  pod_ip=f"10.244.{i // 250}.{i % 250 + 1}")
+    ) for i in range(count)]
+
+
+def benchmarks(args):
+    # name -> zero-argument callable, all inputs are built up front
+    config = BenchConfig(args.env_vars, args.secret_keys)
+    deployment, service, secret = render_manifests(config)
+    deployments = make_deployments(args.deployments)
+    pods = make_pods(args.pods, args.deployments)
+    grouped = group_pods(deployments, pods)
+    statuses = list(grouped_statuses(deployments, grouped))
+    pods_by_app = {}
+    for pod in pods:
+        pods_by_app.setdefault(pod.metadata.labels["app"], []).append(pod)
+
+    selection = parse_fields("deployment.name,pods.name,pods.status")
+    raw_pods = orjson.dumps({"apiVersion": "v1", "kind": "PodList", "metadata": {"resourceVersion": "1"},
+                             "items": [seed_pod(f"pod-{i}", f"app-{i % args.deployments}", i)
+                                       for i in range(args.pods)]})
+    api_client = client.ApiClient()
+    renderer = ManifestRenderer()
+    renderer.render(config)
+
+    env, keys, npods = args.env_vars, args.secret_keys, args.pods
+    cases = {
+        f"render_manifests[env={env}]": lambda: render_manifests(config),
+        f"config_hash[env={env}]": lambda: config_hash(config),
+        f"render_uncached[env={env}]": lambda: ManifestRenderer().render(config),
+        f"render_cached[env={env}]": lambda: renderer.render(config),
+        f"yaml_dump[env={env}]": lambda: yaml.dump(deployment, default_flow_style=False),
+        f"yaml_safe_dump[env={env}]": lambda: yaml.safe_dump(deployment, default_flow_style=False),
+        f"json_dumps[env={env}]": lambda: json.dumps(deployment),
+        # The same comprehension render_manifests runs over the secret data
+        f"secret_base64[keys={keys}]": lambda: {
+            k: base64.b64encode(v.encode()).decode() for k, v in config.secret.data.items()},
+        # Decoding a pod list page, through the client models or into lean objects
+        f"pods_models[pods={npods}]": lambda: api_client._ApiClient__deserialize(orjson.loads(raw_pods), "V1PodList"),
+        f"pods_lean[pods={npods}]": lambda: [lean_pod(obj) for obj in orjson.loads(raw_pods)["items"]],
+        f"pod_summary[pods={npods}]": lambda: [pod_summary(pod) for pod in pods],
+        f"group_pods[pods={npods}]": lambda: group_pods(deployments, pods),
+        f"build_status_per_app[pods={npods}]": lambda: [
+            build_status(d, pods_by_app.get(d.metadata.name, [])) for d in deployments],
+        f"status_json[pods={npods}]": lambda: json.dumps(statuses),
+        f"status_orjson[pods={npods}]": lambda: orjson.dumps(statuses),
+        f"status_projected_orjson[pods={npods}]": lambda: orjson.dumps(
+            [project_status(status, selection) for status in statuses]),
+    }
+    if hasattr(yaml, "CSafeDumper"):
+        cases[f"yaml_dump_libyaml[env={env}]"] = lambda: yaml.dump(deployment, Dumper=yaml.CSafeDumper,
+                                                                    default_flow_style=False)
+    return cases
+
+
+def measure(func):
+    timer = timeit.Timer(func)
+    loops, _ = timer.autorange()
+    runs = sorted(total / loops for total in timer.repeat(REPEAT, loops))
+    return {"loops": loops, "min_ms": round(runs[0] * 1000, 4), "median_ms": round(runs[len(runs) // 2] * 1000, 4)}
+
+
+def run(args):
+    results = {}
+    for name, func in benchmarks(args).items():
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = measure(func)
+        print(f"{name:<40}{results[name]['min_ms']:>12.4f} ms min{results[name]['median_ms']:>12.4f} ms median",
+              flush=True)
+    return results
+
+
+def alternatives(results, env):
+    # How the emitters compare with the pure Python yaml.dump the renderer uses today
+    current = results.get(f"yaml_dump[env={env}]")
+    if current is None:
+        return
+    print(f"\nemitting the deployment with {env} env vars, against yaml.dump")
+    for name in (f"yaml_safe_dump[env={env}]", f"yaml_dump_libyaml[env={env}]", f"json_dumps[env={env}]"):
+        if name in results:
+            print(f"  {name:<38}{current['min_ms'] / results[name]['min_ms']:>8.1f}x faster")
+
+
+def report(results, baseline, tolerance):
+    # Compares the fastest runs, they are the least disturbed by other load on the
+    # machine, and returns the names of cases slower than the tolerance allows
+    print()
+    header = f"{'benchmark':<40}{'baseline ms':>14}{'current ms':>14}{'change':>10}"
+    print(header)
+    print("-" * len(header))
+    slower = []
+    for name, result in results.items():
+        before = baseline["results"].get(name)
+        if before is None:
+            print(f"{name:<40}{'-':>14}{result['min_ms']:>14.4f}{'new':>10}")
+            continue
+        change = result["min_ms"] / before["min_ms"] - 1
+        flag = ""
+        if change > tolerance:
+            slower.append(name)
+            flag = "  SLOWER"
+        print(f"{name:<40}{before['min_ms']:>14.4f}{result['min_ms']:>14.4f}{change:>+10.1%}{flag}")
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of rendering and status building")
+    parser.add_argument("--env-vars", type=int, default=10000)
+    parser.add_argument("--secret-keys", type=int, default=1000)
+    parser.add_argument("--pods", type=int, default=5000)
+    parser.add_argument("--deployments", type=int, default=500)
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    results = run(args)
+    alternatives(results, args.env_vars)
+    if args.save:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(),
+                       "libyaml": hasattr(yaml, "CSafeDumper"), "results": results}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"\nbaseline written to {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        print(f"\nno baseline at {args.baseline}, run with --save to create one")
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("python") != platform.python_version() or baseline.get("machine") != platform.machine():
+        print(f"\nbaseline was recorded on Python {baseline.get('python')} / {baseline.get('machine')}, "
+              f"numbers are only roughly comparable")
+    if report(results, baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
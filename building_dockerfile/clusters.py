@@ -0,0 +1,69 @@
+import os
+from apply_engine import ApplyEngine
+from async_kube import WATCH_POOL_MAXSIZE, AsyncKubeClients
+from kube_clients import KubeClients
+
+# The cluster the service is configured for, in cluster or through the current kubeconfig context
+LOCAL_CLUSTER = "local"
+# Further clusters, as comma separated kubeconfig context names. The context name is the cluster name.
+CLUSTER_CONTEXTS = [context.strip() for context in os.getenv("KAAS_CLUSTERS", "").split(",") if context.strip()]
+# Longest a single cluster may take to answer its part of a fanned out query
+CLUSTER_TIMEOUT_SECONDS = float(os.getenv("CLUSTER_TIMEOUT_SECONDS", "10"))
+
+# Selects every registered cluster
+ALL_CLUSTERS = "*"
+
+
+class UnknownCluster(Exception):
+    pass
+
+
+class Cluster:
+    # Sync and asyncio clients of one cluster and the apply engine on top of them. Rollout
+    # watches go through watch_akube, so long waits cannot take the connections of akube.
+
+    def __init__(self, name, kube, akube, apply_engine=None):
+        self.name = name
+        self.kube = kube
+        self.akube = akube
+        self.watch_akube = AsyncKubeClients(akube.in_cluster, WATCH_POOL_MAXSIZE, akube.context)
+        self.apply_engine = apply_engine or ApplyEngine(kube.api_client)
+
+
+class ClusterRegistry:
+    # Clients per cluster, created once at startup. Every cluster has its own
+    # connection pools, so a slow apiserver only holds up requests to itself.
+
+    def __init__(self, local_kube, local_akube, local_apply_engine=None, contexts=CLUSTER_CONTEXTS):
+        self.clusters = {LOCAL_CLUSTER: Cluster(LOCAL_CLUSTER, local_kube, local_akube, local_apply_engine)}
+        for context in contexts:
+            self.clusters[context] = Cluster(context, KubeClients(False, context=context),
+                                             AsyncKubeClients(False, context=context))
+
+    def names(self):
+        return list(self.clusters)
+
+    def get(self, name):
+        cluster = self.clusters.get(name)
+        if cluster is None:
+            raise UnknownCluster(f"unknown cluster '{name}', known clusters are {', '.join(self.clusters)}")
+        return cluster
+
+    def select(self, selector):
+        # "a,b" -> clusters a and b, "*" -> every cluster
+        if selector.strip() == ALL_CLUSTERS:
+            return list(self.clusters.values())
+        names = list(dict.fromkeys(name.strip() for name in selector.split(",") if name.strip()))
+        return [self.get(name) for name in names]
+
+    async def start(self):
+        for cluster in self.clusters.values():
+            await cluster.akube.start()
+            await cluster.watch_akube.start()
+
+    async def close(self):
+        for cluster in self.clusters.values():
+            await cluster.akube.close()
+            await cluster.watch_akube.close()
+            if cluster.name != LOCAL_CLUSTER:
+                cluster.kube.close()
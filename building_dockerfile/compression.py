@@ -0,0 +1,143 @@
+import os
+import zlib
+from prometheus_client import Counter
+
+try:
+    import zstandard
+except ImportError:
+    # gzip is always available, zstd only when the package is installed
+    zstandard = None
+
+# Responses smaller than this are sent as they are, compressing them costs more than it saves
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+ZSTD_LEVEL = int(os.getenv("ZSTD_LEVEL", "3"))
+
+# Server-sent events are flushed event by event and kept out of compression
+SKIP_CONTENT_TYPES = ("text/event-stream",)
+
+compressed_responses = Counter("http_compressed_responses", "responses sent compressed", ["encoding"])
+compressed_bytes = Counter("http_compressed_bytes", "response bytes before and after compression",
+                           ["encoding", "stage"])
+
+
+def accepted_encodings(header):
+    # Encodings the client accepts, those with q=0 are refused
+    accepted = set()
+    for item in header.split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name and q > 0:
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+def choose_encoding(header):
+    accepted = accepted_encodings(header)
+    if zstandard is not None and "zstd" in accepted:
+        return "zstd"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return None
+
+
+class GzipEncoder:
+    # Each chunk is sync flushed so streamed responses still arrive line by line
+
+    def __init__(self):
+        self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data, final):
+        out = self.compressor.compress(data)
+        return out + self.compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class ZstdEncoder:
+
+    def __init__(self):
+        self.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def compress(self, data, final):
+        out = self.compressor.compress(data)
+        if final:
+            return out + self.compressor.flush()
+        return out + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+
+ENCODERS = {"gzip": GzipEncoder, "zstd": ZstdEncoder}
+
+
+class CompressionMiddleware:
+    # Compresses responses with zstd or gzip, whichever the client accepts, preferring
+    # zstd. The decision is made on the first body chunk: a complete response below
+    # the minimum size goes out untouched.
+
+    def __init__(self, app, minimum_size=COMPRESSION_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        encoding = choose_encoding(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        encoder = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, encoder, passthrough
+            if message["type"] == "http.response.start":
+                response_headers = dict(message.get("headers", []))
+                content_type = response_headers.get(b"content-type", b"").decode("latin-1")
+                if b"content-encoding" in response_headers or content_type.startswith(SKIP_CONTENT_TYPES):
+                    passthrough = True
+                    await send(message)
+                else:
+                    start = message
+                return
+            if passthrough or message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if encoder is None:
+                if not more_body and len(body) < self.minimum_size:
+                    passthrough = True
+                    await send(start)
+                    await send(message)
+                    return
+                encoder = ENCODERS[encoding]()
+                vary = [value for key, value in start.get("headers", []) if key == b"vary"]
+                response_headers = []
+                for key, value in start.get("headers", []):
+                    if key in (b"content-length", b"vary"):
+                        continue
+                    # The compressed bytes differ from the ones a strong ETag names
+                    if key == b"etag" and not value.startswith(b"W/"):
+                        value = b"W/" + value
+                    response_headers.append((key, value))
+                response_headers.append((b"content-encoding", encoding.encode()))
+                response_headers.append((b"vary", b", ".join(vary + [b"Accept-Encoding"])))
+                await send({**start, "headers": response_headers})
+                compressed_responses.labels(encoding).inc()
+
+            compressed = encoder.compress(body, not more_body)
+            compressed_bytes.labels(encoding, "uncompressed").inc(len(body))
+            compressed_bytes.labels(encoding, "compressed").inc(len(compressed))
+            await send({"type": "http.response.body", "body": compressed, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
@@ -0,0 +1,288 @@
+import datetime
+import hashlib
+from types import SimpleNamespace
+import orjson
+from kubernetes_asyncio.client.exceptions import ApiException
+
+# Builds the status dictionaries returned by the deployment status endpoints
+
+# Attributes the fields parameter of the status endpoints can select
+DEPLOYMENT_FIELDS = ("name", "replicas", "available_replicas")
+POD_FIELDS = ("name", "status", "node_name", "start_time", "host_ip", "pod_ip")
+
+
+def deployment_summary(deployment):
+    return {
+        "name": deployment.metadata.name,
+        "replicas": deployment.spec.replicas,
+        "available_replicas": deployment.status.available_replicas
+    }
+
+
+def pod_summary(pod):
+    return {
+        "name": pod.metadata.name,
+        "status": pod.status.phase,
+        "node_name": pod.spec.node_name,
+        "start_time": pod.status.start_time.isoformat() if pod.status.start_time else None,
+        "host_ip": pod.status.host_ip,
+        "pod_ip": pod.status.pod_ip
+    }
+
+
+def build_status(deployment, pods):
+    return {
+        "deployment": deployment_summary(deployment),
+        "pods": [pod_summary(pod) for pod in pods]
+    }
+
+
+def grouped_statuses(deployments, grouped):
+    for deployment in deployments:
+        yield {
+            "deployment": deployment_summary(deployment),
+            "pods": grouped[deployment.metadata.name]
+        }
+
+
+def parse_fields(fields):
+    # "deployment.name,pods.status" -> {"deployment": ["name"], "pods": ["status"]}. A bare
+    # section name keeps the whole section, sections not mentioned are left out. Returns
+    # None when no projection was asked for. Empty items, as in a trailing comma, are skipped.
+    fields = [field.strip() for field in (fields or "").split(",") if field.strip()]
+    if not fields:
+        return None
+    sections = {"deployment": DEPLOYMENT_FIELDS, "pods": POD_FIELDS}
+    selection = {}
+    for field in fields:
+        section, _, attribute = field.partition(".")
+        if section not in sections:
+            raise ValueError(f"unknown field '{field}', fields start with deployment or pods")
+        if not attribute:
+            selection[section] = sections[section]
+        elif attribute not in sections[section]:
+            raise ValueError(f"unknown field '{field}', {section} has {', '.join(sections[section])}")
+        elif selection.get(section) is not sections[section]:
+            selection.setdefault(section, [])
+            if attribute not in selection[section]:
+                selection[section].append(attribute)
+    return selection
+
+
+def project_status(status, selection):
+    # Keeps only the selected sections and attributes of a status, other keys such as
+    # freshness are passed through
+    if selection is None:
+        return status
+    projected = {key: value for key, value in status.items() if key not in ("deployment", "pods")}
+    if "deployment" in selection:
+        projected["deployment"] = {key: status["deployment"][key] for key in selection["deployment"]}
+    if "pods" in selection:
+        keys = selection["pods"]
+        projected["pods"] = [{key: pod[key] for key in keys} for pod in status["pods"]]
+    return projected
+
+
+def status_etag(deployment_versions, pod_versions, variant=""):
+    # Strong ETag over the resourceVersions of the objects a status is built from. Any
+    # change, addition or removal of one of them changes it. The variant keeps different
+    # representations of the same objects (projections, NDJSON) apart.
+    digest = hashlib.sha256(variant.encode())
+    for versions in (deployment_versions, pod_versions):
+        digest.update(b"\0")
+        digest.update("\n".join(sorted(version or "" for version in versions)).encode())
+    return f'"{digest.hexdigest()[:32]}"'
+
+
+def weak_etag(etag):
+    # For bodies that also carry something the ETag does not cover, like how old the data is
+    return etag if etag.startswith("W/") else f"W/{etag}"
+
+
+def etag_matches(if_none_match, etag):
+    # If-None-Match uses the weak comparison, so W/ prefixes (ours, or added when a
+    # response is compressed) are ignored
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any((tag[2:] if tag.startswith("W/") else tag) == opaque for tag in candidates)
+
+
+def ndjson_lines(statuses):
+    for status in statuses:
+        yield orjson.dumps(status) + b"\n"
+
+
+# Page size used when listing objects from the apiserver
+PAGE_SIZE = 500
+
+
+########## lean objects ##########
+# Live reads can skip the generated client models: the raw JSON is parsed with orjson
+# and only the fields the status endpoints read are kept, under the attribute names of
+# the models, so everything below works on either.
+
+async def read_raw(call, *args, **kwargs):
+    # Calls an async client method and returns the undecoded JSON body as dicts
+    response = await call(*args, _preload_content=False, **kwargs)
+    try:
+        body = await response.read()
+    finally:
+        response.release()
+    if not 200 <= response.status <= 299:
+        e = ApiException(status=response.status, reason=response.reason)
+        e.body = body.decode(errors="replace")
+        raise e
+    return orjson.loads(body)
+
+
+def parse_time(value):
+    # fromisoformat only learned the Z suffix in 3.11
+    if not value:
+        return None
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def lean_metadata(metadata):
+    return SimpleNamespace(name=metadata.get("name"), namespace=metadata.get("namespace"),
+                           labels=metadata.get("labels"), resource_version=metadata.get("resourceVersion"))
+
+
+def lean_selector(selector):
+    if selector is None:
+        return None
+    expressions = [SimpleNamespace(key=e["key"], operator=e["operator"], values=e.get("values"))
+                   for e in selector.get("matchExpressions") or []]
+    return SimpleNamespace(match_labels=selector.get("matchLabels"), match_expressions=expressions)
+
+
+def lean_deployment(obj):
+    spec = obj.get("spec") or {}
+    status = obj.get("status") or {}
+    return SimpleNamespace(
+        metadata=lean_metadata(obj["metadata"]),
+        spec=SimpleNamespace(replicas=spec.get("replicas"), selector=lean_selector(spec.get("selector"))),
+        status=SimpleNamespace(available_replicas=status.get("availableReplicas"))
+    )
+
+
+def lean_pod(obj):
+    spec = obj.get("spec") or {}
+    status = obj.get("status") or {}
+    return SimpleNamespace(
+        metadata=lean_metadata(obj["metadata"]),
+        spec=SimpleNamespace(node_name=spec.get("nodeName")),
+        status=SimpleNamespace(phase=status.get("phase"), start_time=parse_time(status.get("startTime")),
+                               host_ip=status.get("hostIP"), pod_ip=status.get("podIP"))
+    )
+
+
+async def read_lean(call, convert, *args, **kwargs):
+    return convert(await read_raw(call, *args, **kwargs))
+
+
+########## listing ##########
+
+async def list_pages(list_func, namespace, page_size=PAGE_SIZE, lean=None, **kwargs):
+    # Yields every page of an async list call, following the continue token. With a lean
+    # converter the page is read as raw JSON and its items are converted one by one.
+    _continue = None
+    while True:
+        if _continue:
+            kwargs["_continue"] = _continue
+        if lean is None:
+            page = await list_func(namespace, limit=page_size, **kwargs)
+        else:
+            raw = await read_raw(list_func, namespace, limit=page_size, **kwargs)
+            metadata = raw.get("metadata") or {}
+            page = SimpleNamespace(
+                metadata=SimpleNamespace(resource_version=metadata.get("resourceVersion"),
+                                         _continue=metadata.get("continue")),
+                items=[lean(obj) for obj in raw.get("items") or []]
+            )
+        yield page
+        _continue = page.metadata._continue
+        if not _continue:
+            break
+
+
+async def list_all(list_func, namespace, page_size=PAGE_SIZE, lean=None, **kwargs):
+    # Returns all items of a paginated list and the resourceVersion of the first page
+    items = []
+    resource_version = None
+    async for page in list_pages(list_func, namespace, page_size, lean, **kwargs):
+        if resource_version is None:
+            resource_version = page.metadata.resource_version
+        items.extend(page.items)
+    return items, resource_version
+
+
+def selector_matches(selector, labels):
+    if selector is None:
+        return False
+    for key, value in (selector.match_labels or {}).items():
+        if labels.get(key) != value:
+            return False
+    for expression in selector.match_expressions or []:
+        present = expression.key in labels
+        if expression.operator == "In" and labels.get(expression.key) not in expression.values:
+            return False
+        if expression.operator == "NotIn" and present and labels[expression.key] in expression.values:
+            return False
+        if expression.operator == "Exists" and not present:
+            return False
+        if expression.operator == "DoesNotExist" and present:
+            return False
+    return True
+
+
+class PodGrouper:
+    # Buckets pod summaries by the name of the deployment whose selector matches them.
+    # Deployments are indexed by one of their matchLabels pairs so that each pod is only
+    # checked against the deployments that could possibly select it.
+
+    def __init__(self, deployments):
+        self.grouped = {deployment.metadata.name: [] for deployment in deployments}
+        self.candidates = {}
+        self.unindexed = []
+        for deployment in deployments:
+            match_labels = deployment.spec.selector.match_labels if deployment.spec.selector else None
+            if match_labels:
+                self.candidates.setdefault(next(iter(match_labels.items())), []).append(deployment)
+            else:
+                self.unindexed.append(deployment)
+
+    def add(self, pod):
+        labels = pod.metadata.labels or {}
+        summary = None
+        for pair in labels.items():
+            for deployment in self.candidates.get(pair, ()):
+                if selector_matches(deployment.spec.selector, labels):
+                    summary = summary or pod_summary(pod)
+                    self.grouped[deployment.metadata.name].append(summary)
+        for deployment in self.unindexed:
+            if selector_matches(deployment.spec.selector, labels):
+                summary = summary or pod_summary(pod)
+                self.grouped[deployment.metadata.name].append(summary)
+
+
+def group_pods(deployments, pods):
+    grouper = PodGrouper(deployments)
+    for pod in pods:
+        grouper.add(pod)
+    return grouper.grouped
+
+
+async def group_pod_pages(deployments, list_func, namespace, lean=None, resource_versions=None):
+    # Groups pods page by page so only one page of full pod objects is held at a time.
+    # The resourceVersion of every pod is appended to resource_versions when given.
+    grouper = PodGrouper(deployments)
+    async for page in list_pages(list_func, namespace, lean=lean):
+        for pod in page.items:
+            grouper.add(pod)
+            if resource_versions is not None:
+                resource_versions.append(pod.metadata.resource_version)
+    return grouper.grouped
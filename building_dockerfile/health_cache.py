@@ -0,0 +1,120 @@
+# Also in health_monitoring/health_cache.py: each image is built from its own directory, so the
+# module is copied rather than shared. Keep the two in step.
+import asyncio
+import os
+import time
+from collections import OrderedDict
+import psycopg
+from prometheus_client import Counter
+
+# Entries are dropped after HEALTH_CACHE_TTL seconds even if no notification arrives
+HEALTH_CACHE_TTL = float(os.getenv("HEALTH_CACHE_TTL", "30"))
+HEALTH_CACHE_SIZE = int(os.getenv("HEALTH_CACHE_SIZE", "1000"))
+
+# LISTEN does not work on a standby, so notifications are received from the master
+NOTIFY_DB_HOST = os.getenv("NOTIFY_DB_HOST", "postgresql-master.default.svc.cluster.local")
+NOTIFY_DB_NAME = os.getenv("DB_NAME", "yourdatabase")
+NOTIFY_DB_USER = os.getenv("DB_USER", "mydbuser")
+NOTIFY_DB_PASSWORD = os.getenv("DB_PASSWORD", "mypassword")
+NOTIFY_CHANNEL = "health_status_changed"
+RECONNECT_BACKOFF_SECONDS = 2
+
+health_cache_hits = Counter("health_cache_hits", "health lookups answered from the cache")
+
+health_cache_misses = Counter("health_cache_misses", "health lookups that went to the database")
+
+health_cache_evictions = Counter("health_cache_evictions", "health cache entries removed", ["reason"])
+
+
+class HealthCache:
+    # Read-through cache of health_status rows keyed by app_name, with a TTL and LRU
+    # eviction. A trigger on health_status sends the changed app_name over NOTIFY and
+    # the matching entry is dropped as soon as it arrives. The notification comes from
+    # the master while misses are read from the slave, which may not have replayed the
+    # change yet, so the first miss after a notification is read from the master.
+
+    def __init__(self, ttl=HEALTH_CACHE_TTL, max_size=HEALTH_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._listener = None
+        self.listening = False
+        # Bumped on every invalidation so a load that raced with one is not stored
+        self._generation = 0
+        # Apps notified about whose next load has to come from the master
+        self._notified = set()
+
+    async def get(self, app_name, loader, master_loader):
+        # Without a live listener we would not hear about changes, so read through
+        if not self.listening:
+            health_cache_misses.inc()
+            return await loader(app_name)
+
+        entry = self._entries.get(app_name)
+        if entry is not None:
+            expires_at, rows = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(app_name)
+                health_cache_hits.inc()
+                return rows
+            del self._entries[app_name]
+            health_cache_evictions.labels("ttl").inc()
+
+        health_cache_misses.inc()
+        generation = self._generation
+        notified = app_name in self._notified
+        rows = await (master_loader if notified else loader)(app_name)
+        if generation != self._generation or not self.listening:
+            return rows
+        self._notified.discard(app_name)
+        self._entries[app_name] = (time.monotonic() + self.ttl, rows)
+        self._entries.move_to_end(app_name)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            health_cache_evictions.labels("lru").inc()
+        return rows
+
+    def invalidate(self, app_name):
+        self._generation += 1
+        self._notified.add(app_name)
+        if self._entries.pop(app_name, None) is not None:
+            health_cache_evictions.labels("notify").inc()
+
+    def clear(self):
+        self._generation += 1
+        if self._entries:
+            health_cache_evictions.labels("reset").inc(len(self._entries))
+            self._entries.clear()
+
+    def start(self):
+        self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+
+    async def _listen(self):
+        while True:
+            try:
+                conn = await psycopg.AsyncConnection.connect(
+                    f"host={NOTIFY_DB_HOST} dbname={NOTIFY_DB_NAME} user={NOTIFY_DB_USER} password={NOTIFY_DB_PASSWORD}",
+                    autocommit=True
+                )
+                async with conn:
+                    await conn.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                    # Changes made while we were not listening are unknown, start over
+                    self.clear()
+                    self.listening = True
+                    async for notify in conn.notifies():
+                        self.invalidate(notify.payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"health cache listener: {str(e)}")
+            self.listening = False
+            self.clear()
+            await asyncio.sleep(RECONNECT_BACKOFF_SECONDS)
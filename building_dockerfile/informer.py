@@ -0,0 +1,168 @@
+import threading
+import time
+from kubernetes import client, watch
+
+# How long a single watch request stays open before we re-issue it
+WATCH_TIMEOUT_SECONDS = 300
+# Backoff between failed list/watch attempts
+RETRY_BACKOFF_SECONDS = 2
+
+
+class Informer:
+    # Keeps an in-memory copy of one resource kind using a single list+watch.
+    # Objects are indexed by (namespace, name) and by (namespace, app label).
+
+    def __init__(self, kind, list_func, namespace="default"):
+        self.kind = kind
+        self.list_func = list_func
+        self.namespace = namespace
+        self.resource_version = None
+        self.last_event_time = None
+        self._objects = {}
+        self._by_app = {}
+        self._lock = threading.Lock()
+        self._synced = threading.Event()
+        self._stop = threading.Event()
+        self._watch = None
+        self._thread = None
+        self._listeners = []
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name=f"informer-{self.kind}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._watch is not None:
+            self._watch.stop()
+
+    def add_listener(self, listener):
+        # listener(event_type, obj) is called on the informer thread after the cache
+        # has been updated. A relist is reported as ("RELIST", None) since the events
+        # in between are not known.
+        self._listeners.append(listener)
+
+    def has_synced(self):
+        return self._synced.is_set()
+
+    def wait_for_sync(self, timeout=None):
+        return self._synced.wait(timeout)
+
+    def freshness(self):
+        with self._lock:
+            age = time.time() - self.last_event_time if self.last_event_time else None
+            return {
+                "source": "cache",
+                "resource_version": self.resource_version,
+                "age_seconds": round(age, 3) if age is not None else None
+            }
+
+    def get(self, namespace, name):
+        with self._lock:
+            return self._objects.get((namespace, name))
+
+    def list(self, namespace):
+        with self._lock:
+            return [self._objects[key] for key in sorted(self._objects) if key[0] == namespace]
+
+    def by_app(self, namespace, app):
+        with self._lock:
+            keys = self._by_app.get((namespace, app), ())
+            return [self._objects[key] for key in sorted(keys)]
+
+    ########################################## internals ##########################################
+
+    def _notify(self, event_type, obj):
+        for listener in self._listeners:
+            try:
+                listener(event_type, obj)
+            except Exception as e:
+                print(f"informer {self.kind} listener: {str(e)}")
+
+    def _index_key(self, obj):
+        labels = obj.metadata.labels or {}
+        return (obj.metadata.namespace, labels.get("app"))
+
+    def _add(self, obj):
+        key = (obj.metadata.namespace, obj.metadata.name)
+        old = self._objects.get(key)
+        if old is not None:
+            self._unindex(key, old)
+        self._objects[key] = obj
+        self._by_app.setdefault(self._index_key(obj), set()).add(key)
+
+    def _delete(self, obj):
+        key = (obj.metadata.namespace, obj.metadata.name)
+        old = self._objects.pop(key, None)
+        if old is not None:
+            self._unindex(key, old)
+
+    def _unindex(self, key, obj):
+        index_key = self._index_key(obj)
+        keys = self._by_app.get(index_key)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_app[index_key]
+
+    def _relist(self):
+        result = self.list_func(self.namespace)
+        with self._lock:
+            self._objects = {}
+            self._by_app = {}
+            for obj in result.items:
+                self._add(obj)
+            self.resource_version = result.metadata.resource_version
+            self.last_event_time = time.time()
+        self._synced.set()
+        self._notify("RELIST", None)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._relist()
+                self._watch_loop()
+            except client.exceptions.ApiException as e:
+                # 410 Gone means our resourceVersion is too old, relist right away
+                if e.status != 410:
+                    print(f"informer {self.kind}: {e.status} {e.reason}")
+                    self._stop.wait(RETRY_BACKOFF_SECONDS)
+            except Exception as e:
+                print(f"informer {self.kind}: {str(e)}")
+                self._stop.wait(RETRY_BACKOFF_SECONDS)
+
+    def _watch_loop(self):
+        while not self._stop.is_set():
+            self._watch = watch.Watch()
+            for event in self._watch.stream(self.list_func,
+                                            self.namespace,
+                                            resource_version=self.resource_version,
+                                            timeout_seconds=WATCH_TIMEOUT_SECONDS,
+                                            allow_watch_bookmarks=True):
+                event_type = event["type"]
+                with self._lock:
+                    if event_type == "BOOKMARK":
+                        self.resource_version = event["raw_object"]["metadata"]["resourceVersion"]
+                    else:
+                        obj = event["object"]
+                        if event_type == "DELETED":
+                            self._delete(obj)
+                        else:
+                            self._add(obj)
+                        self.resource_version = obj.metadata.resource_version
+                    self.last_event_time = time.time()
+                if event_type != "BOOKMARK":
+                    self._notify(event_type, event["object"])
+            # The watch ran its full course without errors, so the cache is still current
+            with self._lock:
+                self.last_event_time = time.time()
+
+
+def deployment_informer(apps_v1, namespace="default"):
+    return Informer("deployments", apps_v1.list_namespaced_deployment, namespace)
+
+
+def pod_informer(core_v1, namespace="default"):
+    return Informer("pods", core_v1.list_namespaced_pod, namespace)
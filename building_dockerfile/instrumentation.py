@@ -0,0 +1,59 @@
+import time
+from prometheus_client import CONTENT_TYPE_LATEST, Gauge, Histogram, generate_latest
+from starlette.responses import Response
+
+# Seconds, from cache hits up to deploys that wait for a rollout
+REQUEST_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+http_request_duration_seconds = Histogram("http_request_duration_seconds", "time spent answering a request",
+                                          ["method", "route", "status"], buckets=REQUEST_DURATION_BUCKETS)
+
+http_requests_in_progress = Gauge("http_requests_in_progress", "requests currently being answered", ["method"])
+
+
+class MetricsMiddleware:
+    # Times every request from the first byte received to the last byte sent. Requests
+    # are labelled with the route template, not the raw path, so /health/{app_name}
+    # is one series however many apps are looked up.
+
+    def __init__(self, app, skip_paths=("/metrics",)):
+        self.app = app
+        self.skip_paths = skip_paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.skip_paths:
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        # Stays 500 if the app raises before a response is started
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_requests_in_progress.labels(method).inc()
+        t1 = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            t2 = time.perf_counter()
+            # The router stores the matched route in the scope. A middleware that answers
+            # before routing, like admission control, names the route under route_path.
+            route = scope.get("route")
+            route_path = route.path if route is not None else scope.get("route_path", "unmatched")
+            http_request_duration_seconds.labels(method, route_path, str(status)).observe(t2-t1)
+            http_requests_in_progress.labels(method).dec()
+
+
+def metrics(request):
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+def instrument(app):
+    # Serves /metrics from the app itself and times every other route
+    app.add_middleware(MetricsMiddleware)
+    app.add_route("/metrics", metrics, include_in_schema=False)
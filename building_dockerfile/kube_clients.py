@@ -0,0 +1,53 @@
+import os
+import threading
+from kubernetes import client, config
+
+# Size of the urllib3 connection pool shared by every API call in the process
+POOL_MAXSIZE = int(os.getenv("KUBE_POOL_MAXSIZE", "32"))
+
+
+class KubeClients:
+    # One ApiClient per process. Both config loaders install a refresh hook on the
+    # configuration that re-reads the token only once it has expired, so credentials
+    # stay valid without re-parsing the config on every request.
+    # A kubeconfig context selects another cluster, those clients never become the default.
+
+    def __init__(self, in_cluster, pool_maxsize=POOL_MAXSIZE, context=None):
+        self.in_cluster = in_cluster
+        self.context = context
+        self.configuration = client.Configuration()
+        if in_cluster:
+            config.load_incluster_config(client_configuration=self.configuration)
+        else:
+            config.load_kube_config(context=context, client_configuration=self.configuration, persist_config=False)
+        self.configuration.connection_pool_maxsize = pool_maxsize
+        if context is None:
+            client.Configuration.set_default(self.configuration)
+
+        self.api_client = client.ApiClient(self.configuration)
+        self.apps_v1 = client.AppsV1Api(self.api_client)
+        self.core_v1 = client.CoreV1Api(self.api_client)
+
+    def close(self):
+        self.api_client.close()
+
+
+_clients = None
+_lock = threading.Lock()
+
+
+def load(in_cluster):
+    # The first caller decides how the process authenticates, later calls reuse it
+    global _clients
+    with _lock:
+        if _clients is None:
+            _clients = KubeClients(in_cluster)
+        return _clients
+
+
+def get(in_cluster=None):
+    if _clients is not None:
+        return _clients
+    if in_cluster is None:
+        in_cluster = "KUBERNETES_SERVICE_HOST" in os.environ
+    return load(in_cluster)
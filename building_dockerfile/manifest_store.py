@@ -0,0 +1,83 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+import yaml
+
+# Revisions kept per app and number of apps kept, least recently deployed apps go first
+MANIFEST_REVISIONS = int(os.getenv("MANIFEST_REVISIONS", "10"))
+MANIFEST_APPS = int(os.getenv("MANIFEST_APPS", "1000"))
+
+REDACTED = "<redacted>"
+
+
+def redact_secret(secret):
+    # Keeps the keys of a Secret but none of its values
+    redacted = dict(secret)
+    redacted['data'] = {key: REDACTED for key in secret.get('data', {})}
+    return redacted
+
+
+class ManifestStore:
+    # In-memory history of rendered manifests per app. Bodies are stored once per
+    # config hash and shared by every revision that points at them, secret values
+    # are never kept.
+
+    def __init__(self, revisions_per_app=MANIFEST_REVISIONS, max_apps=MANIFEST_APPS):
+        self.revisions_per_app = revisions_per_app
+        self.max_apps = max_apps
+        self._apps = OrderedDict()
+        self._bodies = {}
+        self._refs = {}
+        self._lock = threading.Lock()
+
+    def record(self, appname, rendered):
+        digest = rendered["hash"]
+        with self._lock:
+            history = self._apps.pop(appname, None) or {"next": 1, "revisions": OrderedDict()}
+            self._apps[appname] = history
+
+            revisions = history["revisions"]
+            if revisions and next(reversed(revisions.values()))["config_hash"] == digest:
+                return next(reversed(revisions))
+
+            if digest not in self._bodies:
+                self._bodies[digest] = {
+                    "deployment_yaml": rendered["deployment_yaml"],
+                    "service_yaml": rendered["service_yaml"],
+                    "secret_yaml": yaml.dump(redact_secret(rendered["secret"]), default_flow_style=False)
+                }
+            self._refs[digest] = self._refs.get(digest, 0) + 1
+
+            revision = history["next"]
+            history["next"] += 1
+            revisions[revision] = {"revision": revision, "config_hash": digest, "recorded_at": time.time()}
+            while len(revisions) > self.revisions_per_app:
+                _, dropped = revisions.popitem(last=False)
+                self._release(dropped["config_hash"])
+            while len(self._apps) > self.max_apps:
+                _, dropped_app = self._apps.popitem(last=False)
+                for dropped in dropped_app["revisions"].values():
+                    self._release(dropped["config_hash"])
+            return revision
+
+    def revisions(self, appname):
+        with self._lock:
+            history = self._apps.get(appname)
+            if history is None:
+                return None
+            return [dict(entry) for entry in history["revisions"].values()]
+
+    def get(self, appname, revision):
+        with self._lock:
+            history = self._apps.get(appname)
+            entry = history["revisions"].get(revision) if history else None
+            if entry is None:
+                return None
+            return {**entry, **self._bodies[entry["config_hash"]]}
+
+    def _release(self, digest):
+        self._refs[digest] -= 1
+        if self._refs[digest] == 0:
+            del self._refs[digest]
+            del self._bodies[digest]
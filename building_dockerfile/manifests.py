@@ -0,0 +1,217 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import re
+import secrets
+import threading
+from collections import OrderedDict
+import yaml
+
+# Kubernetes object name rules: DNS-1123 labels for apps and services, subdomains for secrets
+DNS_LABEL = re.compile(r"^[a-z0-9]([-a-z0-9]*[a-z0-9])?$")
+DNS_SUBDOMAIN = re.compile(r"^[a-z0-9]([-a-z0-9]*[a-z0-9])?(\.[a-z0-9]([-a-z0-9]*[a-z0-9])?)*$")
+SERVICE_TYPES = ("ClusterIP", "NodePort", "LoadBalancer")
+NODE_PORT_RANGE = (30000, 32767)
+
+# Annotation carrying the hash of the FullConfig an object was rendered from
+CONFIG_HASH_ANNOTATION = "kaas-api/config-hash"
+# The hash is readable by anyone who can read the objects, so secret values only enter it
+# through an HMAC with this key. Give every replica the same key, otherwise each process
+# picks its own and applies are skipped only for configs it applied itself.
+CONFIG_HASH_KEY = os.getenv("CONFIG_HASH_KEY", "").encode() or secrets.token_bytes(32)
+if not os.getenv("CONFIG_HASH_KEY"):
+    print("warning: CONFIG_HASH_KEY is not set, unchanged configs are only skipped until this process restarts "
+          "and not across replicas")
+RENDER_CACHE_SIZE = 256
+
+
+def validate_full_config(config):
+    # Returns a list of problems that would make the apiserver reject the manifests
+    errors = []
+    if len(config.deployment.appname) > 63 or not DNS_LABEL.match(config.deployment.appname):
+        errors.append(f"deployment.appname '{config.deployment.appname}' is not a valid DNS-1123 label")
+    if len(config.service.name) > 63 or not DNS_LABEL.match(config.service.name):
+        errors.append(f"service.name '{config.service.name}' is not a valid DNS-1123 label")
+    for field, name in (("secret.name", config.secret.name), ("deployment.secret_name", config.deployment.secret_name)):
+        if len(name) > 253 or not DNS_SUBDOMAIN.match(name):
+            errors.append(f"{field} '{name}' is not a valid DNS-1123 subdomain")
+    if config.deployment.replicas < 0:
+        errors.append("deployment.replicas must not be negative")
+    if not 1 <= config.deployment.container_port <= 65535:
+        errors.append("deployment.container_port must be between 1 and 65535")
+    if config.service.external_access not in SERVICE_TYPES:
+        errors.append(f"service.external_access must be one of {', '.join(SERVICE_TYPES)}")
+    elif config.service.external_access != "ClusterIP" and not NODE_PORT_RANGE[0] <= config.service.node_port <= NODE_PORT_RANGE[1]:
+        errors.append(f"service.node_port must be between {NODE_PORT_RANGE[0]} and {NODE_PORT_RANGE[1]}")
+    return errors
+
+
+def validate_batch(configs):
+    # Validates every config and rejects names or node ports used twice in the same batch
+    errors = []
+    seen = {}
+    for index, config in enumerate(configs):
+        for error in validate_full_config(config):
+            errors.append({"index": index, "error": error})
+        keys = [("deployment.appname", config.deployment.appname),
+                ("service.name", config.service.name),
+                ("secret.name", config.secret.name)]
+        if config.service.external_access != "ClusterIP":
+            keys.append(("service.node_port", config.service.node_port))
+        for key in keys:
+            if key in seen:
+                errors.append({"index": index, "error": f"{key[0]} '{key[1]}' is already used by item {seen[key]}"})
+            else:
+                seen[key] = index
+    return errors
+
+
+def render_manifests(config):
+    # Deployment
+    deployment = {
+        'apiVersion': 'apps/v1',
+        'kind': 'Deployment',
+        'metadata': {
+            'name': config.deployment.appname
+        },
+        'spec': {
+            'replicas': config.deployment.replicas,
+            'selector': {
+                'matchLabels': {
+                    'app': config.deployment.appname
+                }
+            },
+            'template': {
+                'metadata': {
+                    'labels': {
+                        'app': config.deployment.appname
+                    }
+                },
+                'spec': {
+                    'containers': [
+                        {
+                            'name': config.deployment.appname,
+                            'image': f"{config.deployment.imageaddress}:{config.deployment.imagetag}",
+                            'ports': [
+                                {'containerPort': config.deployment.container_port}
+                            ],
+                            'resources': {
+                                'requests': {
+                                    'memory': config.deployment.memory_request,
+                                    'cpu': config.deployment.cpu_request
+                                },
+                            },
+                            'env': [
+                                {'name': k, 'value': v} for k, v in config.deployment.env_vars.items()
+                            ],
+                            'volumeMounts': [
+                                {
+                                    'name': 'secret-volume',
+                                    'mountPath': '/etc/secrets'
+                                }
+                            ]
+                        }
+                    ],
+                    'volumes': [
+                        {
+                            'name': 'secret-volume',
+                            'secret': {
+                                'secretName': config.deployment.secret_name
+                            }
+                        }
+                    ]
+                }
+            }
+        }
+    }
+
+    # Service, the apiserver refuses a nodePort on ClusterIP services
+    port = {
+        'protocol': 'TCP',
+        'port': config.deployment.container_port,
+        'targetPort': config.deployment.container_port
+    }
+    if config.service.external_access != "ClusterIP":
+        port['nodePort'] = config.service.node_port
+    service = {
+        'apiVersion': 'v1',
+        'kind': 'Service',
+        'metadata': {
+            'name': config.service.name
+        },
+        'spec': {
+            'selector': {
+                'app': config.deployment.appname
+            },
+            'type': config.service.external_access,
+            'ports': [port]
+        }
+    }
+
+    # Secret
+    encoded_data = {k: base64.b64encode(v.encode()).decode() for k, v in config.secret.data.items()}
+    secret = {
+        'apiVersion': 'v1',
+        'kind': 'Secret',
+        'metadata': {
+            'name': config.secret.name
+        },
+        'data': encoded_data,
+        'type': 'Opaque'
+    }
+
+    return deployment, service, secret
+
+
+def config_hash(config):
+    # Hash of the normalized config, key order does not change it
+    dumped = config.model_dump()
+    secret_data = json.dumps(dumped["secret"]["data"], sort_keys=True, separators=(",", ":"))
+    dumped["secret"]["data"] = hmac.new(CONFIG_HASH_KEY, secret_data.encode(), hashlib.sha256).hexdigest()
+    normalized = json.dumps(dumped, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+def live_config_hash(obj):
+    if obj is None:
+        return None
+    return (obj.metadata.annotations or {}).get(CONFIG_HASH_ANNOTATION)
+
+
+class ManifestRenderer:
+    # Renders manifests and their YAML once per distinct config, keeping the most
+    # recently used results keyed by the config hash.
+
+    def __init__(self, max_size=RENDER_CACHE_SIZE):
+        self.max_size = max_size
+        self._rendered = OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, config):
+        digest = config_hash(config)
+        with self._lock:
+            rendered = self._rendered.get(digest)
+            if rendered is not None:
+                self._rendered.move_to_end(digest)
+                return rendered
+
+        deployment, service, secret = render_manifests(config)
+        for manifest in (deployment, service, secret):
+            manifest['metadata'].setdefault('annotations', {})[CONFIG_HASH_ANNOTATION] = digest
+        rendered = {
+            "hash": digest,
+            "deployment": deployment,
+            "service": service,
+            "secret": secret,
+            "deployment_yaml": yaml.dump(deployment, default_flow_style=False),
+            "service_yaml": yaml.dump(service, default_flow_style=False),
+            "secret_yaml": yaml.dump(secret, default_flow_style=False)
+        }
+
+        with self._lock:
+            self._rendered[digest] = rendered
+            while len(self._rendered) > self.max_size:
+                self._rendered.popitem(last=False)
+        return rendered
@@ -0,0 +1,266 @@
+import asyncio
+import json
+import os
+import socket
+import uuid
+from psycopg.rows import dict_row
+from psycopg.types.json import Jsonb
+from psycopg_pool import AsyncConnectionPool
+from prometheus_client import Counter, Gauge
+from async_kube import run_blocking
+from tracing import span, start_trace
+
+# Jobs are written, so they live on the master and not on the slave the health API reads
+JOBS_DB_HOST = os.getenv("JOBS_DB_HOST", "postgresql-master.default.svc.cluster.local")
+JOBS_DB_NAME = os.getenv("DB_NAME", "yourdatabase")
+JOBS_DB_USER = os.getenv("DB_USER", "mydbuser")
+JOBS_DB_PASSWORD = os.getenv("DB_PASSWORD", "mypassword")
+
+# Number of jobs provisioned at the same time, and how many may wait behind them
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+# A replica holds a lease on each job it has queued or runs and renews it while it lives.
+# Jobs whose lease ran out, because their replica stopped or died, are claimed by another.
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "30"))
+JOB_CLAIM_INTERVAL_SECONDS = JOB_LEASE_SECONDS / 3
+RECOVERY_BACKOFF_SECONDS = 5
+
+CREATE_JOBS_TABLE = """
+    CREATE TABLE IF NOT EXISTS provisioning_jobs (
+        id UUID PRIMARY KEY,
+        kind TEXT NOT NULL,
+        params JSONB NOT NULL,
+        status TEXT NOT NULL,
+        steps JSONB NOT NULL DEFAULT '{}'::jsonb,
+        result JSONB,
+        error TEXT,
+        owner TEXT,
+        lease_until TIMESTAMPTZ,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+"""
+
+# Tables created before jobs were leased
+ADD_LEASE_COLUMNS = """
+    ALTER TABLE provisioning_jobs ADD COLUMN IF NOT EXISTS owner TEXT,
+                                  ADD COLUMN IF NOT EXISTS lease_until TIMESTAMPTZ
+"""
+
+INSERT_JOB = """
+    INSERT INTO provisioning_jobs (id, kind, params, status, owner, lease_until)
+    VALUES (%s, %s, %s, 'queued', %s, now() + make_interval(secs => %s)) RETURNING *
+"""
+
+SELECT_JOB = "SELECT * FROM provisioning_jobs WHERE id = %s"
+
+# Takes over unfinished jobs nobody holds a lease on, oldest first. SKIP LOCKED lets
+# replicas claim at the same time without waiting for each other or taking the same job.
+CLAIM_EXPIRED_JOBS = """
+    UPDATE provisioning_jobs SET owner = %s, lease_until = now() + make_interval(secs => %s)
+    WHERE id IN (
+        SELECT id FROM provisioning_jobs
+        WHERE status IN ('queued', 'running') AND (lease_until IS NULL OR lease_until < now())
+        ORDER BY created_at LIMIT %s FOR UPDATE SKIP LOCKED
+    )
+    RETURNING *
+"""
+
+RENEW_LEASES = """
+    UPDATE provisioning_jobs SET lease_until = now() + make_interval(secs => %s)
+    WHERE owner = %s AND status IN ('queued', 'running')
+"""
+
+# On shutdown, so another replica takes the jobs over without waiting for the lease to run out
+RELEASE_LEASES = """
+    UPDATE provisioning_jobs SET lease_until = NULL WHERE owner = %s AND status IN ('queued', 'running')
+"""
+
+# Only the owner records the outcome, a replica that lost its lease does not overwrite the new owner's
+UPDATE_JOB_STATUS = """
+    UPDATE provisioning_jobs SET status = %s, result = %s, error = %s, updated_at = now() WHERE id = %s AND owner = %s
+"""
+
+# Merges one step into the steps object so concurrent step updates do not overwrite each other.
+# Like the status, only the owner records progress.
+UPDATE_JOB_STEP = """
+    UPDATE provisioning_jobs SET steps = steps || jsonb_build_object(%s::text, %s::jsonb), updated_at = now()
+    WHERE id = %s AND owner = %s
+"""
+
+# Replicas starting together create the table one after the other
+SCHEMA_LOCK = "SELECT pg_advisory_xact_lock(hashtext('provisioning_jobs'))"
+
+provisioning_jobs_total = Counter("provisioning_jobs", "provisioning jobs finished", ["kind", "status"])
+
+provisioning_jobs_queued = Gauge("provisioning_jobs_queued", "provisioning jobs waiting for a worker")
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobQueue:
+    # Runs provisioning in the background on a fixed number of workers. Every job and
+    # the progress of each of its steps is stored in Postgres, so the status can be
+    # polled from any replica. Each job is leased by the replica that runs it, jobs left
+    # unfinished by a replica that stopped are claimed by exactly one other replica.
+    # Handlers are blocking functions called as handler(params, progress, completed_steps).
+
+    def __init__(self, handlers, workers=JOB_WORKERS, queue_size=JOB_QUEUE_SIZE):
+        self.handlers = handlers
+        self.workers = workers
+        self.pool = AsyncConnectionPool(
+            f"host={JOBS_DB_HOST} dbname={JOBS_DB_NAME} user={JOBS_DB_USER} password={JOBS_DB_PASSWORD}",
+            min_size=1,
+            max_size=workers + 2,
+            open=False,
+            kwargs={"row_factory": dict_row, "autocommit": True},
+            name="jobs-db"
+        )
+        self.queue_size = queue_size
+        # Names this process as the owner of the jobs it leases
+        self.owner = f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+        # Created in start, before 3.10 a queue binds to the loop current at creation
+        self._queue = None
+        self._enqueued = set()
+        # Resolved when a job submitted by this process finishes, for callers that wait on it
+        self._waiters = {}
+        self._tasks = []
+        self._schema_ready = False
+
+    async def start(self):
+        # Like the health pool, the app starts even if the database is not reachable yet
+        await self.pool.open(wait=False)
+        self._start_workers()
+        self._tasks.append(asyncio.create_task(self._lease()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        try:
+            async with self.pool.connection(timeout=RECOVERY_BACKOFF_SECONDS) as conn:
+                await conn.execute(RELEASE_LEASES, (self.owner,))
+        except Exception as e:
+            print(f"job leases: could not release: {str(e)}")
+        await self.pool.close()
+
+    def _start_workers(self):
+        self._queue = asyncio.Queue()
+        provisioning_jobs_queued.set_function(self._queue.qsize)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def _ensure_schema(self, conn):
+        # Run by whichever comes first, the lease task or a submit, so a fresh database
+        # has the table before the first job is inserted
+        if self._schema_ready:
+            return
+        async with conn.transaction():
+            await conn.execute(SCHEMA_LOCK)
+            await conn.execute(CREATE_JOBS_TABLE)
+            await conn.execute(ADD_LEASE_COLUMNS)
+        self._schema_ready = True
+
+    async def _lease(self):
+        # Renews the leases of this process and claims expired jobs, as many as fit in the queue
+        while True:
+            try:
+                async with self.pool.connection() as conn:
+                    await self._ensure_schema(conn)
+                break
+            except Exception as e:
+                print(f"job leases: {str(e)}")
+                await asyncio.sleep(RECOVERY_BACKOFF_SECONDS)
+        while True:
+            try:
+                async with self.pool.connection() as conn:
+                    await conn.execute(RENEW_LEASES, (JOB_LEASE_SECONDS, self.owner))
+                    room = self.queue_size - self._queue.qsize()
+                    if room > 0:
+                        cur = await conn.execute(CLAIM_EXPIRED_JOBS, (self.owner, JOB_LEASE_SECONDS, room))
+                        for job in await cur.fetchall():
+                            self._enqueue(job)
+            except Exception as e:
+                print(f"job leases: {str(e)}")
+            await asyncio.sleep(JOB_CLAIM_INTERVAL_SECONDS)
+
+    def _enqueue(self, job):
+        if job["id"] not in self._enqueued:
+            self._enqueued.add(job["id"])
+            self._queue.put_nowait(job)
+
+    async def submit(self, kind, params):
+        if self._queue.qsize() >= self.queue_size:
+            raise QueueFull(f"{self._queue.qsize()} jobs are already waiting")
+        with span("db.insert_job", kind=kind):
+            async with self.pool.connection() as conn:
+                await self._ensure_schema(conn)
+                cur = await conn.execute(INSERT_JOB, (uuid.uuid4(), kind, Jsonb(params), self.owner, JOB_LEASE_SECONDS))
+                job = await cur.fetchone()
+        self._waiters[job["id"]] = asyncio.get_running_loop().create_future()
+        self._enqueue(job)
+        return job
+
+    async def wait(self, job_id, timeout):
+        # Returns False if the job is still running after timeout seconds
+        waiter = self._waiters.get(job_id)
+        if waiter is None:
+            return True
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def get(self, job_id):
+        with span("db.get_job"):
+            async with self.pool.connection() as conn:
+                await self._ensure_schema(conn)
+                cur = await conn.execute(SELECT_JOB, (job_id,))
+                return await cur.fetchone()
+
+    async def _set_status(self, job_id, status, result=None, error=None):
+        async with self.pool.connection() as conn:
+            await conn.execute(UPDATE_JOB_STATUS, (status, Jsonb(result) if result is not None else None, error, job_id,
+                                                   self.owner))
+
+    async def _set_step(self, job_id, step, state):
+        async with self.pool.connection() as conn:
+            await conn.execute(UPDATE_JOB_STEP, (step, json.dumps(state), job_id, self.owner))
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._queue.get()
+            job_id = job["id"]
+            completed_steps = {step for step, state in job["steps"].items() if state["status"] == "done"}
+
+            def progress(step, status, seconds):
+                # Called from the worker thread, waits until the step is stored
+                state = {"status": status, "seconds": seconds}
+                asyncio.run_coroutine_threadsafe(self._set_step(job_id, step, state), loop).result()
+
+            try:
+                await self._set_status(job_id, "running")
+                # Jobs run outside of any request, so each one gets a trace of its own
+                with start_trace("provisioning.job", kind=job["kind"], job_id=str(job_id)):
+                    result = await run_blocking(self.handlers[job["kind"]], job["params"], progress, completed_steps)
+                await self._set_status(job_id, "succeeded", result=result)
+                provisioning_jobs_total.labels(job["kind"], "succeeded").inc()
+            except asyncio.CancelledError:
+                # Left as running, stop releases the lease and another replica resumes it
+                raise
+            except Exception as e:
+                error = getattr(e, "detail", None) or str(e)
+                try:
+                    await self._set_status(job_id, "failed", error=str(error))
+                except Exception as db_error:
+                    print(f"job {job_id}: could not record failure: {str(db_error)}")
+                provisioning_jobs_total.labels(job["kind"], "failed").inc()
+            finally:
+                self._enqueued.discard(job_id)
+                waiter = self._waiters.pop(job_id, None)
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(None)
+                self._queue.task_done()
@@ -0,0 +1,162 @@
+import asyncio
+import os
+import time
+from kubernetes_asyncio import watch
+from kubernetes_asyncio.client.exceptions import ApiException
+
+# Upper bound of a single watch request, the watch is reopened until the timeout is reached
+WATCH_TIMEOUT_SECONDS = 60
+RETRY_BACKOFF_SECONDS = 1
+# Requests allowed to wait on a rollout at once, beyond that wait=true is refused with 429
+ROLLOUT_WAITERS = int(os.getenv("ROLLOUT_WAITERS", "16"))
+
+
+def deployment_rollout(deployment):
+    # Same checks as kubectl rollout status
+    spec, status = deployment.spec, deployment.status
+    if (status.observed_generation or 0) < deployment.metadata.generation:
+        return "progressing", "waiting for the new spec to be observed"
+    for condition in status.conditions or []:
+        if condition.type == "Progressing" and condition.reason == "ProgressDeadlineExceeded":
+            return "failed", condition.message
+    replicas = spec.replicas if spec.replicas is not None else 1
+    if (status.updated_replicas or 0) < replicas:
+        return "progressing", f"{status.updated_replicas or 0} of {replicas} replicas updated"
+    if (status.replicas or 0) > (status.updated_replicas or 0):
+        return "progressing", f"{status.replicas - status.updated_replicas} old replicas pending termination"
+    if (status.available_replicas or 0) < (status.updated_replicas or 0):
+        return "progressing", f"{status.available_replicas or 0} of {status.updated_replicas} replicas available"
+    return "ready", None
+
+
+def statefulset_rollout(statefulset):
+    # StatefulSets have no progress deadline, they are either ready or still progressing
+    spec, status = statefulset.spec, statefulset.status
+    if (status.observed_generation or 0) < statefulset.metadata.generation:
+        return "progressing", "waiting for the new spec to be observed"
+    replicas = spec.replicas if spec.replicas is not None else 1
+    if (status.ready_replicas or 0) < replicas:
+        return "progressing", f"{status.ready_replicas or 0} of {replicas} replicas ready"
+    if status.update_revision and status.current_revision != status.update_revision:
+        return "progressing", f"{status.updated_replicas or 0} of {replicas} replicas updated"
+    return "ready", None
+
+
+async def watch_rollout(list_func, check, namespace, name):
+    # The first watch starts with the current object, so a rollout that is already
+    # done is reported right away. Reopened watches resume from the last version seen.
+    resource_version = None
+    while True:
+        w = watch.Watch()
+        events = 0
+        try:
+            async for event in w.stream(list_func, namespace, field_selector=f"metadata.name={name}",
+                                        resource_version=resource_version, timeout_seconds=WATCH_TIMEOUT_SECONDS):
+                events += 1
+                if event["type"] == "DELETED":
+                    return "failed", "deleted while waiting for the rollout"
+                if event["type"] not in ("ADDED", "MODIFIED"):
+                    continue
+                resource_version = event["object"].metadata.resource_version
+                state, reason = check(event["object"])
+                if state != "progressing":
+                    return state, reason
+        except ApiException as e:
+            # Our resource version has been compacted away, start from the current object
+            if e.status != 410:
+                raise
+            resource_version = None
+        finally:
+            await w.close()
+        if events == 0:
+            await asyncio.sleep(RETRY_BACKOFF_SECONDS)
+
+
+class CachedRollouts:
+    # Answers rollout waits from the events of an informer instead of opening a watch per
+    # waiter. Waiters are woken on the loop whenever their object changes. The cache can
+    # still hold the object from before the apply, so a waiter only accepts an object of
+    # at least the generation the apply returned.
+
+    def __init__(self, informer, check):
+        self.informer = informer
+        self.check = check
+        self._waiters = {}
+        self._loop = None
+
+    def start(self):
+        # Informer listeners run on the informer thread, waiters are resolved on the loop
+        self._loop = asyncio.get_running_loop()
+        self.informer.add_listener(
+            lambda event_type, obj: self._loop.call_soon_threadsafe(self._on_event, event_type, obj))
+
+    async def wait(self, namespace, name, min_generation=None):
+        key = (namespace, name)
+        future = self._loop.create_future()
+        waiter = (future, min_generation or 0)
+        waiters = self._waiters.setdefault(key, [])
+        waiters.append(waiter)
+        try:
+            self._resolve(key)
+            return await future
+        finally:
+            waiters.remove(waiter)
+            if not waiters:
+                del self._waiters[key]
+
+    ########## internals ##########
+
+    def _on_event(self, event_type, obj):
+        # A relist may have changed any object, every waiter takes another look
+        keys = list(self._waiters) if event_type == "RELIST" else [(obj.metadata.namespace, obj.metadata.name)]
+        for key in keys:
+            self._resolve(key, event_type == "DELETED")
+
+    def _resolve(self, key, deleted=False):
+        # The cache is read again rather than trusting the event, it may be newer by now
+        obj = self.informer.get(*key)
+        for future, min_generation in self._waiters.get(key, ()):
+            if future.done():
+                continue
+            if obj is None:
+                if deleted:
+                    future.set_result(("failed", "deleted while waiting for the rollout"))
+                continue
+            if (obj.metadata.generation or 0) < min_generation:
+                continue
+            state, reason = self.check(obj)
+            if state != "progressing":
+                future.set_result((state, reason))
+
+
+async def wait_for_rollout(kind, name, rollout, timeout):
+    # Blocks on the rollout coroutine until the workload is ready, has failed or timeout passes
+    t1 = time.time()
+    try:
+        state, reason = await asyncio.wait_for(rollout, timeout)
+    except asyncio.TimeoutError:
+        state, reason = "timeout", f"not ready after {timeout} seconds"
+    t2 = time.time()
+    return {
+        "kind": kind,
+        "name": name,
+        "status": state,
+        "reason": reason,
+        "seconds": round(t2-t1, 4)
+    }
+
+
+async def wait_for_deployment(apps_v1, namespace, name, timeout, cache=None, min_generation=None):
+    # With a CachedRollouts of the namespace no watch is opened
+    if cache is not None:
+        rollout = cache.wait(namespace, name, min_generation)
+    else:
+        rollout = watch_rollout(apps_v1.list_namespaced_deployment, deployment_rollout, namespace, name)
+    return await wait_for_rollout("Deployment", name, rollout, timeout)
+
+
+async def wait_for_statefulset(apps_v1, namespace, name, timeout):
+    return await wait_for_rollout("StatefulSet", name,
+                                  watch_rollout(apps_v1.list_namespaced_stateful_set, statefulset_rollout,
+                                                namespace, name),
+                                  timeout)
@@ -1,27 +1,243 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request
 from pydantic import BaseModel
-import yaml
-import subprocess
-import base64
-from kubernetes import client, config
-from prometheus_client import start_http_server, Summary, Counter
-from service4kuber import deploy_postgresql, get_db_connection
-from psycopg2.extras import RealDictCursor
-from fastapi.responses import JSONResponse
+from typing import List
+from kubernetes import client
+from kubernetes_asyncio.client.exceptions import ApiException as AsyncApiException
+from prometheus_client import Summary, Counter
+from service4kuber import deploy_postgresql, POSTGRES_STEPS
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse, Response, StreamingResponse
+import kube_clients
+from async_kube import AsyncKubeClients, BLOCKING_WORKERS, run_blocking
+from informer import deployment_informer, pod_informer
+from apply_engine import ApplyEngine
+from manifests import DNS_LABEL, ManifestRenderer, live_config_hash, validate_batch
+from manifest_store import ManifestStore
+from db_pool import MASTER_DB_HOST, MASTER_DB_POOL_MAX_SIZE, DBPool
+from health_cache import HealthCache
+from provisioning_jobs import JobQueue, QueueFull
+from clusters import ALL_CLUSTERS, CLUSTER_TIMEOUT_SECONDS, LOCAL_CLUSTER, ClusterRegistry, UnknownCluster
+from rollout import ROLLOUT_WAITERS, CachedRollouts, deployment_rollout, wait_for_deployment, wait_for_statefulset
+from status_stream import StatusBroadcaster
+from instrumentation import instrument
+from compression import CompressionMiddleware
+from admission import RETRY_AFTER_SECONDS, AdmissionMiddleware, ConcurrencyLimiter, Overloaded, SingleFlight
+from tracing import TracingMiddleware, span
+from deployment_status import (build_status, grouped_statuses, group_pods, group_pod_pages, list_all, ndjson_lines,
+                               parse_fields, project_status, lean_deployment, lean_pod, read_lean, status_etag,
+                               etag_matches, weak_etag)
+import asyncio
+import contextlib
+import os
 import time
+import uuid
 app = FastAPI()
 
+# Requests of an expensive endpoint allowed to run at once, and to wait for a slot beyond that.
+# A wait=true deploy gives its slot back once applied, rollout waits are bounded by rollout_waiters.
+ADMISSION_LIMITS = {
+    "/receiving_status_of_all_deployments": (int(os.getenv("STATUS_ALL_CONCURRENCY", "8")),
+                                             int(os.getenv("STATUS_ALL_QUEUE", "32"))),
+    "/receiving_status_of_specific_deployment": (int(os.getenv("STATUS_CONCURRENCY", "32")),
+                                                 int(os.getenv("STATUS_QUEUE", "128"))),
+    "/generate-deployment/": (int(os.getenv("DEPLOY_CONCURRENCY", "16")), int(os.getenv("DEPLOY_QUEUE", "64"))),
+    "/generate-deployments/batch": (int(os.getenv("BATCH_CONCURRENCY", "2")), int(os.getenv("BATCH_QUEUE", "32"))),
+}
+# Requests over the limits are shed with 429 or 503 and Retry-After, inside the metrics so they are counted
+app.add_middleware(AdmissionMiddleware, limiters=[ConcurrencyLimiter(path, limit, queue)
+                                                  for path, (limit, queue) in ADMISSION_LIMITS.items()])
+# Per-route latency histograms and /metrics, served on the API port
+instrument(app)
+# Spans of every request in the Server-Timing header and the trace file
+app.add_middleware(TracingMiddleware)
+# zstd or gzip for large responses, whichever the client accepts
+app.add_middleware(CompressionMiddleware)
+
 number_of_requests =  Counter("num_of_requests", "total number of requeests")
 
 number_of_failed_requests = Counter("num_of__failed_requests", "total number of failed requeests")
 
-request_processing_time = Summary("request_processing_time", "request process time")
-
 number_of_db_errors = Counter("number_of_db_errors", "total number of database errors")
 
 db_response_time = Summary("db_response_time","database response time")
-# Load Kubernetes configuration
-config.load_incluster_config()
+
+cluster_status_queries = Counter("cluster_status_queries", "per cluster outcome of fanned out status queries",
+                                 ["cluster", "result"])
+# Load Kubernetes configuration once, every handler shares these clients
+IN_CLUSTER = True
+
+# Live status reads parse the raw JSON into lean objects instead of the client models
+LEAN_LISTS = os.getenv("LEAN_LISTS", "true").lower() == "true"
+kube = kube_clients.load(IN_CLUSTER)
+
+# asyncio clients used by the status endpoints, started with the event loop
+akube = AsyncKubeClients(IN_CLUSTER)
+
+# Applies generated manifests through the API with server-side apply
+apply_engine = ApplyEngine(kube.api_client)
+
+# Clients of every cluster the endpoints can target, the local cluster uses the ones above
+clusters = ClusterRegistry(kube, akube, apply_engine)
+
+# Identical status reads running at the same time share one sweep of the apiserver
+status_flights = SingleFlight("status")
+
+# wait=true requests allowed at once, the rest are refused right away rather than queued
+rollout_waiters = ConcurrencyLimiter("rollout_wait", ROLLOUT_WAITERS, 0)
+
+# Rendered manifests keyed by config hash, and the history of what was applied per app
+renderer = ManifestRenderer()
+manifest_store = ManifestStore()
+
+# Pooled connections to the health database, opened at startup
+db_pool = DBPool()
+# The master, for the first read of an app after a change was announced
+master_db_pool = DBPool(MASTER_DB_HOST, min_size=1, max_size=MASTER_DB_POOL_MAX_SIZE, name="health-db-master")
+
+# health_status rows cached per app, invalidated through LISTEN/NOTIFY
+health_cache = HealthCache()
+
+@app.on_event("startup")
+async def open_db_pool():
+    await db_pool.open()
+    await master_db_pool.open()
+    health_cache.start()
+
+@app.on_event("shutdown")
+async def close_db_pool():
+    await health_cache.stop()
+    await db_pool.close()
+    await master_db_pool.close()
+
+def run_postgresql_job(params, progress, completed_steps):
+    # Jobs queued without a cluster or namespace go to the local default namespace
+    cluster = clusters.get(params.get("cluster", LOCAL_CLUSTER))
+    return deploy_postgresql(params["appname"], params["cpu"], params["memory"], params["external"],
+                             progress=progress, completed_steps=completed_steps,
+                             namespace=params.get("namespace", "default"), kube=cluster.kube)
+
+# PostgreSQL provisioning runs as background jobs persisted in the master database
+jobs = JobQueue({"postgresql": run_postgresql_job})
+
+@app.on_event("startup")
+async def start_jobs():
+    await jobs.start()
+
+@app.on_event("shutdown")
+async def stop_jobs():
+    await jobs.stop()
+
+# In-memory copies of deployments and pods of one namespace of the local cluster, kept current by a watch
+CACHED_NAMESPACE = "default"
+deployments_cache = None
+pods_cache = None
+
+# Pushes status changes seen by the informers to every event stream client
+status_broadcaster = None
+
+@app.on_event("startup")
+async def start_async_clients():
+    await clusters.start()
+
+@app.on_event("shutdown")
+async def close_async_clients():
+    await clusters.close()
+
+@app.on_event("startup")
+def start_informers():
+    global deployments_cache, pods_cache
+    deployments_cache = deployment_informer(kube.apps_v1, CACHED_NAMESPACE)
+    pods_cache = pod_informer(kube.core_v1, CACHED_NAMESPACE)
+    deployments_cache.start()
+    pods_cache.start()
+
+@app.on_event("startup")
+async def start_status_broadcaster():
+    global status_broadcaster
+    status_broadcaster = StatusBroadcaster(deployments_cache, pods_cache, CACHED_NAMESPACE)
+    status_broadcaster.start()
+
+# Rollout waits in the cached namespace are answered from the deployment informer
+deployment_rollouts = None
+
+@app.on_event("startup")
+async def start_deployment_rollouts():
+    global deployment_rollouts
+    deployment_rollouts = CachedRollouts(deployments_cache, deployment_rollout)
+    deployment_rollouts.start()
+
+@app.on_event("shutdown")
+def stop_informers():
+    deployments_cache.stop()
+    pods_cache.stop()
+
+def caches_synced():
+    return deployments_cache is not None and deployments_cache.has_synced() and pods_cache.has_synced()
+
+def is_cached(cluster, namespace):
+    return cluster.name == LOCAL_CLUSTER and namespace == CACHED_NAMESPACE and caches_synced()
+
+def validate_namespace(namespace):
+    if len(namespace) > 63 or not DNS_LABEL.match(namespace):
+        raise HTTPException(status_code=400, detail=f"namespace '{namespace}' is not a valid DNS-1123 label")
+    return namespace
+
+def select_target(cluster, namespace):
+    # The cluster and namespace of an endpoint that acts on exactly one of each
+    try:
+        return clusters.get(cluster), validate_namespace(namespace)
+    except UnknownCluster as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+def select_targets(cluster, namespace):
+    # Every (cluster, namespace) pair of comma separated selectors, "*" selects every cluster
+    try:
+        selected = clusters.select(cluster)
+    except UnknownCluster as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    namespaces = list(dict.fromkeys(validate_namespace(name.strip()) for name in namespace.split(",") if name.strip()))
+    if not selected or not namespaces:
+        raise HTTPException(status_code=400, detail="at least one cluster and one namespace must be selected")
+    return [(target, name) for target in selected for name in namespaces]
+
+@contextlib.asynccontextmanager
+async def rollout_wait_slot(wait):
+    # Taken before anything is applied, so a refused request has changed nothing
+    if not wait:
+        yield
+        return
+    try:
+        await rollout_waiters.acquire()
+    except Overloaded as e:
+        raise HTTPException(status_code=e.status_code, detail=e.reason, headers={"Retry-After": str(e.retry_after)})
+    t1 = time.time()
+    try:
+        yield
+    finally:
+        rollout_waiters.release(time.time() - t1)
+
+def release_admission(request):
+    # Frees the admission slot of the endpoint before a rollout wait, waiters are bounded
+    # by rollout_waiters instead and the wait does not count as service time
+    release = request.scope.get("admission_release")
+    if release is not None:
+        release()
+
+def manifest_key(cluster, namespace, appname):
+    # The local default namespace keeps the history under the bare app name
+    if cluster == LOCAL_CLUSTER and namespace == CACHED_NAMESPACE:
+        return appname
+    return f"{cluster}/{namespace}/{appname}"
+
+def cache_freshness():
+    deployments_freshness = deployments_cache.freshness()
+    pods_freshness = pods_cache.freshness()
+    return {
+        "source": "cache",
+        "resource_version": deployments_freshness["resource_version"],
+        "pods_resource_version": pods_freshness["resource_version"],
+        "age_seconds": max(deployments_freshness["age_seconds"] or 0, pods_freshness["age_seconds"] or 0)
+    }
 
 class DeploymentConfig(BaseModel):
     appname: str
@@ -55,296 +271,432 @@ class PostgresConfig(BaseModel):
     cpu: str
     memory: str
     external: bool
-@request_processing_time.time()
-@app.post("/generate-deployment/")
-def generate_deployment(config: FullConfig):
-    number_of_requests.inc()
-    t1 = time.time()
+
+def read_live_deployment(appname, cluster, namespace, cached=True):
+    if cached and is_cached(cluster, namespace):
+        return deployments_cache.get(namespace, appname)
     try:
+        with span("k8s.read_deployment", resource=appname, cluster=cluster.name, namespace=namespace):
+            return cluster.kube.apps_v1.read_namespaced_deployment(appname, namespace)
+    except client.exceptions.ApiException as e:
+        if e.status == 404:
+            return None
+        raise
+
+def applied_generation(response):
+    # Generation of the Deployment as applied, None when the apply was skipped
+    for applied in response["applied"]:
+        if applied["kind"] == "Deployment":
+            return applied["generation"]
+    return None
 
-        deployment = {
-            'apiVersion': 'apps/v1',
-            'kind': 'Deployment',
-            'metadata': {
-                'name': config.deployment.appname
-            },
-            'spec': {
-                'replicas': config.deployment.replicas,
-                'selector': {
-                    'matchLabels': {
-                        'app': config.deployment.appname
-                    }
-                },
-                'template': {
-                    'metadata': {
-                        'labels': {
-                            'app': config.deployment.appname
-                        }
-                    },
-                    'spec': {
-                        'containers': [
-                            {
-                                'name': config.deployment.appname,
-                                'image': f"{config.deployment.imageaddress}:{config.deployment.imagetag}",
-                                'ports': [
-                                    {'containerPort': config.deployment.container_port}
-                                ],
-                                'resources': {
-                                    'requests': {
-                                        'memory': config.deployment.memory_request,
-                                        'cpu': config.deployment.cpu_request
-                                    },
-                                },
-                                'env': [
-                                    {'name': k, 'value': v} for k, v in config.deployment.env_vars.items()
-                                ],
-                                'volumeMounts': [
-                                    {
-                                        'name': 'secret-volume',
-                                        'mountPath': '/etc/secrets'
-                                    }
-                                ]
-                            }
-                        ],
-                        'volumes': [
-                            {
-                                'name': 'secret-volume',
-                                'secret': {
-                                    'secretName': config.deployment.secret_name
-                                }
-                            }
-                        ]
-                    }
+def deploy_full_config(config, cluster, namespace):
+    with span("render", appname=config.deployment.appname):
+        rendered = renderer.render(config)
+    deployment_yaml = rendered["deployment_yaml"]
+    service_yaml = rendered["service_yaml"]
+    secret_yaml = rendered["secret_yaml"]
+
+    # The Deployment is applied last, if it already carries this hash nothing changed. The
+    # cache can lag behind a revert applied moments ago, so a match there is confirmed
+    # with a read from the apiserver before the apply is skipped.
+    deployment = read_live_deployment(config.deployment.appname, cluster, namespace)
+    if live_config_hash(deployment) == rendered["hash"] and is_cached(cluster, namespace):
+        deployment = read_live_deployment(config.deployment.appname, cluster, namespace, cached=False)
+    if live_config_hash(deployment) == rendered["hash"]:
+        return {"message": "Deployment, Service, and Secret are already up to date.",
+                "noop": True,
+                "config_hash": rendered["hash"],
+                "deployment_yaml": deployment_yaml,
+                "service_yaml": service_yaml,
+                "secret_yaml": secret_yaml,
+                "applied": []
                 }
-            }
-        }
 
-        # Service YAML
-        service = {
-            'apiVersion': 'v1',
-            'kind': 'Service',
-            'metadata': {
-                'name': config.service.name
-            },
-            'spec': {
-                'selector': {
-                    'app': config.deployment.appname
-                },
-                'type': config.service.external_access,
-                'ports': [
-                    {
-                        'protocol': 'TCP',
-                        'port': config.deployment.container_port,
-                        'targetPort': config.deployment.container_port,
-                        'nodePort': config.service.node_port
-                    }
-                ]
+    # Apply the manifests with server-side apply, the Secret lands before the Deployment
+    applied = cluster.apply_engine.apply([rendered["secret"], rendered["service"], rendered["deployment"]], namespace)
+    revision = manifest_store.record(manifest_key(cluster.name, namespace, config.deployment.appname), rendered)
+    return {"message": "Deployment, Service, and Secret created successfully.",
+            "noop": False,
+            "config_hash": rendered["hash"],
+            "revision": revision,
+            "deployment_yaml": deployment_yaml,
+            "service_yaml": service_yaml,
+            "secret_yaml": secret_yaml,
+            "applied": applied
             }
-        }
 
-        # Secret YAML
-        encoded_data = {k: base64.b64encode(v.encode()).decode() for k, v in config.secret.data.items()}
-        secret = {
-            'apiVersion': 'v1',
-            'kind': 'Secret',
-            'metadata': {
-                'name': config.secret.name,
-                'namespace': "default"
-            },
-            'data': encoded_data,
-            'type': 'Opaque'
-        }
+@app.post("/generate-deployment/")
+async def generate_deployment(request: Request, config: FullConfig, wait: bool = False, timeout: float = Query(300, gt=0, le=3600),
+                              cluster: str = LOCAL_CLUSTER, namespace: str = "default"):
+    number_of_requests.inc()
+    target, namespace = select_target(cluster, namespace)
+    async with rollout_wait_slot(wait):
+        try:
+            response = await run_blocking(deploy_full_config, config, target, namespace)
+            if wait:
+                # Block until the rollout is ready or has failed. The cached namespace is answered
+                # by the informer, elsewhere the Deployment is watched.
+                release_admission(request)
+                cache = deployment_rollouts if is_cached(target, namespace) else None
+                with span("k8s.watch_rollout", resource=config.deployment.appname, cached=cache is not None):
+                    response["rollout"] = await wait_for_deployment(target.watch_akube.apps_v1, namespace,
+                                                                    config.deployment.appname, timeout, cache,
+                                                                    applied_generation(response))
+            return response
+        except Exception as e:
+            number_of_failed_requests.inc()
+            raise HTTPException(status_code=500, detail=str(e))
 
-        # Generate the YAML content
-        deployment_yaml = yaml.dump(deployment, default_flow_style=False)
-        service_yaml = yaml.dump(service, default_flow_style=False)
-        secret_yaml = yaml.dump(secret, default_flow_style=False)
+@app.get("/manifests/{appname}")
+def list_manifest_revisions(appname: str, cluster: str = LOCAL_CLUSTER, namespace: str = "default"):
+    target, namespace = select_target(cluster, namespace)
+    revisions = manifest_store.revisions(manifest_key(target.name, namespace, appname))
+    if revisions is None:
+        raise HTTPException(status_code=404, detail="No manifests recorded for this app")
+    return revisions
 
-        # Save the YAML content to files
-        deployment_filename = f"{config.deployment.appname}-deployment.yaml"
-        service_filename = f"{config.service.name}.yaml"
-        secret_filename = f"{config.secret.name}-secret.yaml"
+@app.get("/manifests/{appname}/{revision}")
+def get_manifest_revision(appname: str, revision: int, cluster: str = LOCAL_CLUSTER, namespace: str = "default"):
+    target, namespace = select_target(cluster, namespace)
+    manifests = manifest_store.get(manifest_key(target.name, namespace, appname), revision)
+    if manifests is None:
+        raise HTTPException(status_code=404, detail="Revision not found")
+    return manifests
 
-        with open(deployment_filename, 'w') as file:
-            file.write(deployment_yaml)
-        
-        with open(service_filename, 'w') as file:
-            file.write(service_yaml)
-
-        with open(secret_filename, 'w') as file:
-            file.write(secret_yaml)
-
-        # Apply the YAML files using kubectl
-        subprocess.run(["kubectl", "apply", "-f", deployment_filename], check=True)
-        subprocess.run(["kubectl", "apply", "-f", service_filename], check=True)
-        subprocess.run(["kubectl", "apply", "-f", secret_filename], check=True)
-        t2 = time.time()
-        request_processing_time.observe(t2-t1)
-        return {"message": "Deployment, Service, and Secret created successfully.",
-                "deployment_yaml": deployment_yaml,
-                "service_yaml": service_yaml,
-                "secret_yaml": secret_yaml
-                }
-    except Exception as e:
-        t2 = time.time()
-        request_processing_time.observe(t2-t1)
+@app.post("/generate-deployments/batch")
+async def generate_deployments_batch(configs: List[FullConfig], concurrency: int = Query(8, ge=1),
+                                     cluster: str = LOCAL_CLUSTER, namespace: str = "default"):
+    number_of_requests.inc()
+    t1 = time.time()
+    target, namespace = select_target(cluster, namespace)
+
+    # Nothing is applied unless every item is valid
+    errors = validate_batch(configs)
+    if errors:
         number_of_failed_requests.inc()
-        raise HTTPException(status_code=500, detail=str(e))
+        raise HTTPException(status_code=422, detail=errors)
+
+    # Each item runs on the blocking pool, so more than its size would only queue
+    semaphore = asyncio.Semaphore(min(concurrency, BLOCKING_WORKERS))
+
+    async def deploy_one(index, config):
+        async with semaphore:
+            t_item = time.time()
+            result = {"index": index, "appname": config.deployment.appname}
+            try:
+                response = await run_blocking(deploy_full_config, config, target, namespace)
+                result["status"] = "success"
+                result["applied"] = response["applied"]
+            except Exception as e:
+                result["status"] = "failed"
+                result["error"] = str(e)
+            result["seconds"] = round(time.time() - t_item, 4)
+            return result
 
-@request_processing_time.time()
+    results = await asyncio.gather(*(deploy_one(index, config) for index, config in enumerate(configs)))
+    failed = sum(1 for result in results if result["status"] == "failed")
+    if failed:
+        number_of_failed_requests.inc()
+    t2 = time.time()
+    return {"succeeded": len(results) - failed,
+            "failed": failed,
+            "seconds": round(t2-t1, 4),
+            "results": results
+            }
+
+async def read_status(cluster, namespace, appname):
+    # Read the specified deployment and list its pods concurrently
+    with span("k8s.read_status", resource=appname, cluster=cluster.name, namespace=namespace, lean=LEAN_LISTS):
+        if LEAN_LISTS:
+            read_deployment = read_lean(cluster.akube.apps_v1.read_namespaced_deployment, lean_deployment,
+                                        appname, namespace)
+        else:
+            read_deployment = cluster.akube.apps_v1.read_namespaced_deployment(appname, namespace)
+        deployment, (pods, _) = await asyncio.gather(
+            read_deployment,
+            list_all(cluster.akube.core_v1.list_namespaced_pod, namespace, lean=lean_pod if LEAN_LISTS else None,
+                     label_selector=f"app={appname}")
+        )
+    return deployment, pods
+
+def precondition_response(request, etag):
+    # A matching If-None-Match is answered 304 on GET and HEAD, and 412 on any other method
+    if request.method in ("GET", "HEAD"):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(status_code=412, headers={"ETag": etag})
+
+# Polled with If-None-Match, GET is accepted as well so caches in between can revalidate
+@app.get("/receiving_status_of_specific_deployment")
 @app.post("/receiving_status_of_specific_deployment")
-def get_deployment_status(appname: str):
+async def get_deployment_status(request: Request, appname: str, fields: str = None,
+                                cluster: str = LOCAL_CLUSTER, namespace: str = "default"):
     number_of_requests.inc()
-    t1 = time.time()
+    try:
+        selection = parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    target, namespace = select_target(cluster, namespace)
+    if_none_match = request.headers.get("if-none-match")
     try:
 
-        # Load kube config to authenticate
-        config.load_kube_config()
-        
-        # Initialize API clients
-        apps_v1 = client.AppsV1Api()
-        core_v1 = client.CoreV1Api()
-        
-        # Read the specified deployment
-        deployment = apps_v1.read_namespaced_deployment(appname, "default")
-        
-        # List pods with the specified label selector
-        pods = core_v1.list_namespaced_pod("default", label_selector=f"app={appname}")
+        # Answer from the informer cache once it has synced
+        deployment = deployments_cache.get(namespace, appname) if is_cached(target, namespace) else None
+        if deployment is not None:
+            pods = pods_cache.by_app(namespace, appname)
+            # Weak, the freshness in the body differs between the cache and live reads and over time
+            etag = weak_etag(status_etag([deployment.metadata.resource_version],
+                                         [pod.metadata.resource_version for pod in pods], repr(selection)))
+            if etag_matches(if_none_match, etag):
+                return precondition_response(request, etag)
+            status = build_status(deployment, pods)
+            status["freshness"] = cache_freshness()
+            return ORJSONResponse(project_status(status, selection), headers={"ETag": etag})
+
+        deployment, pods = await status_flights.do(("deployment", target.name, namespace, appname),
+                                                   read_status, target, namespace, appname)
         
+        etag = weak_etag(status_etag([deployment.metadata.resource_version],
+                                     [pod.metadata.resource_version for pod in pods], repr(selection)))
+        if etag_matches(if_none_match, etag):
+            return precondition_response(request, etag)
+
         # Prepare the status dictionary
-        status = {
-            "deployment": {
-                "name": deployment.metadata.name,
-                "replicas": deployment.spec.replicas,
-                "available_replicas": deployment.status.available_replicas
-            },
-            "pods": []
+        status = build_status(deployment, pods)
+        status["freshness"] = {
+            "source": "live",
+            "resource_version": deployment.metadata.resource_version,
+            "age_seconds": 0
         }
         
-        # Append pod details to the status dictionary
-        for pod in pods.items:
-            status["pods"].append({
-                "name": pod.metadata.name,
-                "status": pod.status.phase,
-                "node_name": pod.spec.node_name,
-                "start_time": pod.status.start_time.isoformat() if pod.status.start_time else None,
-                "host_ip": pod.status.host_ip,
-                "pod_ip": pod.status.pod_ip
-            })
-        
         # Return the final status
-        t2 = time.time()
-        request_processing_time.observe(t2-t1)
-        return status
-    except client.exceptions.ApiException as e:
-        t2 = time.time()
-        request_processing_time.observe(t2-t1)
+        return ORJSONResponse(project_status(status, selection), headers={"ETag": etag})
+    except (client.exceptions.ApiException, AsyncApiException) as e:
         number_of_failed_requests.inc()
         raise HTTPException(status_code=500, detail=str(e))
 
-@request_processing_time.time()
+async def list_statuses(cluster, namespace):
+    # Deployments and pods of one namespace with the resourceVersions the ETag is built from.
+    # Pods read live are grouped while paging, cached ones only once a body is needed. Every
+    # page is read before anything is returned: any page may hold a pod of any deployment,
+    # and the ETag covers all of them. Only one page of pod objects is held at a time, the
+    # summaries kept per deployment still grow with the namespace.
+    if is_cached(cluster, namespace):
+        pods = pods_cache.list(namespace)
+        return {"deployments": deployments_cache.list(namespace), "pods": pods, "grouped": None,
+                "pod_versions": [pod.metadata.resource_version for pod in pods], "freshness": cache_freshness()}
+
+    # List all deployments in the specified namespace
+    with span("k8s.list_deployments", cluster=cluster.name, namespace=namespace, lean=LEAN_LISTS):
+        deployments, resource_version = await list_all(cluster.akube.apps_v1.list_namespaced_deployment, namespace,
+                                                       lean=lean_deployment if LEAN_LISTS else None)
+
+    # List all pods once, page by page, and group them by deployment selector
+    with span("k8s.list_pods", cluster=cluster.name, namespace=namespace, lean=LEAN_LISTS):
+        pod_versions = []
+        grouped = await group_pod_pages(deployments, cluster.akube.core_v1.list_namespaced_pod, namespace,
+                                        lean=lean_pod if LEAN_LISTS else None, resource_versions=pod_versions)
+    return {"deployments": deployments, "pods": None, "grouped": grouped, "pod_versions": pod_versions,
+            "freshness": {"source": "live", "resource_version": resource_version, "age_seconds": 0}}
+
+def listing_etag(listing, variant):
+    return status_etag([deployment.metadata.resource_version for deployment in listing["deployments"]],
+                       listing["pod_versions"], variant)
+
+def listing_statuses(listing, selection):
+    grouped = listing["grouped"]
+    if grouped is None:
+        grouped = group_pods(listing["deployments"], listing["pods"])
+    return (project_status(status, selection) for status in grouped_statuses(listing["deployments"], grouped))
+
+async def fan_out(targets):
+    # Lists every (cluster, namespace) at once, each under its own timeout, so a slow or
+    # unreachable cluster fails alone and the others are still answered
+    async def list_target(cluster, namespace):
+        result = {"cluster": cluster.name, "namespace": namespace}
+        t1 = time.time()
+        try:
+            result["listing"] = await asyncio.wait_for(
+                status_flights.do(("namespace", cluster.name, namespace), list_statuses, cluster, namespace),
+                CLUSTER_TIMEOUT_SECONDS)
+            result["status"] = "ok"
+        except asyncio.TimeoutError:
+            result["status"] = "timeout"
+            result["error"] = f"no answer within {CLUSTER_TIMEOUT_SECONDS} seconds"
+        except (client.exceptions.ApiException, AsyncApiException) as e:
+            result["status"] = "error"
+            result["error"] = f"({e.status}) {e.reason}"
+        except Exception as e:
+            result["status"] = "error"
+            result["error"] = str(e)
+        result["seconds"] = round(time.time() - t1, 4)
+        cluster_status_queries.labels(cluster.name, result["status"]).inc()
+        return result
+
+    return await asyncio.gather(*(list_target(cluster, namespace) for cluster, namespace in targets))
+
+def fan_out_lines(results, selection):
+    # One line per status tagged with its cluster and namespace, and one per target that failed
+    for result in results:
+        if result["status"] != "ok":
+            yield {key: result[key] for key in ("cluster", "namespace", "status", "error")}
+            continue
+        for status in listing_statuses(result["listing"], selection):
+            yield {"cluster": result["cluster"], "namespace": result["namespace"], **status}
+
+def fan_out_body(results, selection, partial):
+    targets = []
+    for result in results:
+        target = {key: value for key, value in result.items() if key != "listing"}
+        if result["status"] == "ok":
+            target["freshness"] = result["listing"]["freshness"]
+            target["statuses"] = list(listing_statuses(result["listing"], selection))
+        targets.append(target)
+    return {"partial": partial, "targets": targets}
+
+async def fan_out_statuses(targets, selection, stream, variant, if_none_match):
+    results = await fan_out(targets)
+    failed = sum(1 for result in results if result["status"] != "ok")
+    headers = {"X-Partial-Results": "true" if failed else "false"}
+
+    # Only complete results are validated, a cluster that did not answer may have changed.
+    # Weak, the body also carries each target's freshness and timing.
+    if not failed:
+        versions = [f"{result['cluster']}/{result['namespace']}/{listing_etag(result['listing'], variant)}"
+                    for result in results]
+        headers["ETag"] = weak_etag(status_etag(versions, [], variant))
+        if etag_matches(if_none_match, headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+
+    status_code = 502 if failed == len(results) else 200
+    if stream:
+        return StreamingResponse(ndjson_lines(fan_out_lines(results, selection)), status_code=status_code,
+                                 media_type="application/x-ndjson", headers=headers)
+    return ORJSONResponse(fan_out_body(results, selection, failed > 0), status_code=status_code, headers=headers)
+
 @app.get("/receiving_status_of_all_deployments")
-def get_all_deployment_statuses():
+async def get_all_deployment_statuses(request: Request, stream: bool = False, fields: str = None,
+                                      cluster: str = LOCAL_CLUSTER, namespace: str = "default"):
     number_of_requests.inc()
-    t1 = time.time()
     try:
-        t1 = time.time()
-        # Load kube config to authenticate
-        config.load_kube_config()
-        
-        # Initialize API clients
-        apps_v1 = client.AppsV1Api()
-        core_v1 = client.CoreV1Api()
-        
-        # List all deployments in the specified namespace
-        deployments = apps_v1.list_namespaced_deployment("default")
-        
-        # Prepare the status dictionary
-        all_statuses = []
-        
-        # Iterate over each deployment
-        for deployment in deployments.items:
-            deployment_name = deployment.metadata.name
-            
-            # List pods with the specified label selector
-            pods = core_v1.list_namespaced_pod("default", label_selector=f"app={deployment_name}")
-            
-            # Prepare the status dictionary for this deployment
-            status = {
-                "deployment": {
-                    "name": deployment_name,
-                    "replicas": deployment.spec.replicas,
-                    "available_replicas": deployment.status.available_replicas
-                },
-                "pods": []
-            }
-            
-            # Append pod details to the status dictionary
-            for pod in pods.items:
-                pod_status = {
-                    "name": pod.metadata.name,
-                    "status": pod.status.phase,
-                    "node_name": pod.spec.node_name,
-                    "start_time": pod.status.start_time.isoformat() if pod.status.start_time else None,
-                    "host_ip": pod.status.host_ip,
-                    "pod_ip": pod.status.pod_ip
-                }
-                status["pods"].append(pod_status)
-            
-            # Append the status of this deployment to the list of all statuses
-            all_statuses.append(status)
-        
-        # Return the final statuses
-        t2 = time.time()
-        request_processing_time.observe(t2-t1)
-        return all_statuses
-    except client.exceptions.ApiException as e:
-        t2 = time.time()
-        request_processing_time.observe(t2-t1)
+        selection = parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    targets = select_targets(cluster, namespace)
+    variant = f"{'ndjson' if stream else 'json'} {selection!r}"
+    if_none_match = request.headers.get("if-none-match")
+
+    # Several clusters or namespaces are answered per target, with partial results
+    if cluster.strip() == ALL_CLUSTERS or "," in cluster or "," in namespace:
+        return await fan_out_statuses(targets, selection, stream, variant, if_none_match)
+
+    target, namespace = targets[0]
+    try:
+        listing = await status_flights.do(("namespace", target.name, namespace), list_statuses, target, namespace)
+        freshness = listing["freshness"]
+        headers = {
+            "ETag": listing_etag(listing, variant),
+            "X-Cache-Source": freshness["source"],
+            "X-Resource-Version": str(freshness["resource_version"]),
+            "X-Cache-Age-Seconds": str(freshness["age_seconds"])
+        }
+        # Nothing changed since the caller's copy, skip building and sending it
+        if etag_matches(if_none_match, headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+        all_statuses = listing_statuses(listing, selection)
+
+        # Return the final statuses. NDJSON is encoded line by line as it is sent, so the
+        # body is never held whole. The first byte still waits for the listing above.
+        if stream:
+            return StreamingResponse(ndjson_lines(all_statuses), media_type="application/x-ndjson", headers=headers)
+        return ORJSONResponse(content=list(all_statuses), headers=headers)
+    except (client.exceptions.ApiException, AsyncApiException) as e:
         number_of_failed_requests.inc()
         raise HTTPException(status_code=500, detail=str(e))
 
-@request_processing_time.time()
+def job_status(job):
+    # Steps that have not started yet are listed as pending
+    job["steps"] = [{"step": step, **job["steps"].get(step, {"status": "pending", "seconds": None})}
+                    for step in POSTGRES_STEPS]
+    return job
+
+@app.get("/deployment-status-events")
+async def stream_deployment_statuses(request: Request, resource_version: str = None):
+    # Server-Sent Events, a snapshot of every deployment followed by one status per change.
+    # Reconnecting clients resume after Last-Event-ID, or resource_version if given.
+    if not caches_synced():
+        raise HTTPException(status_code=503, detail="Deployment cache has not synced yet")
+    last_event_id = request.headers.get("Last-Event-ID") or resource_version
+    return StreamingResponse(status_broadcaster.subscribe(last_event_id), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.post("/deploy-postgresql")
-async def deploy_postgres(appname: str, cpu: str, memory: str, external: bool):
+async def deploy_postgres(appname: str, cpu: str, memory: str, external: bool,
+                          wait: bool = False, timeout: float = Query(300, gt=0, le=3600),
+                          cluster: str = LOCAL_CLUSTER, namespace: str = "default"):
 
     number_of_requests.inc()
     t1 = time.time()
-    try:
+    target, namespace = select_target(cluster, namespace)
+    async with rollout_wait_slot(wait):
+        try:
+
+           # Provisioning takes a while, queue it and let the client poll the job
+           job = await jobs.submit("postgresql", {"appname": appname, "cpu": cpu, "memory": memory, "external": external,
+                                                  "cluster": target.name, "namespace": namespace})
+           content = {
+               "job_id": str(job["id"]),
+               "status": job["status"],
+               "status_url": f"/deploy-postgresql/jobs/{job['id']}"
+           }
+           status_code = 202
+           if wait:
+               # Wait for the job, then watch the StatefulSet for whatever is left of the timeout
+               if await jobs.wait(job["id"], timeout):
+                   status_code = 200
+                   content.update(job_status(await jobs.get(job["id"])))
+                   if content["status"] == "succeeded":
+                       remaining = max(0, timeout - (time.time() - t1))
+                       with span("k8s.watch_rollout", resource=appname):
+                           content["rollout"] = await wait_for_statefulset(target.watch_akube.apps_v1, namespace,
+                                                                           appname, remaining)
+               content["seconds"] = round(time.time() - t1, 4)
+           return JSONResponse(status_code=status_code, content=jsonable_encoder(content))
+        except QueueFull as e:
+            number_of_failed_requests.inc()
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+        except Exception as e:
+            number_of_failed_requests.inc()
+            raise HTTPException(status_code=500, detail=str(e))
 
-       response = deploy_postgresql(appname, cpu, memory, external)
-       t2 = time.time()
-       request_processing_time.observe(t2-t1)
-       return response
+@app.get("/deploy-postgresql/jobs/{job_id}")
+async def get_postgres_job(job_id: uuid.UUID):
+    try:
+        job = await jobs.get(job_id)
     except Exception as e:
-        t2 = time.time()
-        request_processing_time.observe(t2-t1)
-        number_of_failed_requests.inc()
+        number_of_db_errors.inc()
         raise HTTPException(status_code=500, detail=str(e))
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return JSONResponse(content=jsonable_encoder(job_status(job)))
 
 @app.get('/health/{app_name}')
 async def get_health(app_name: str):
     try:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
         t1 = time.time() #in
-        cur.execute('SELECT * FROM health_status WHERE app_name = %s', (app_name,))
-        health_status = cur.fetchall()
-        t2 = time.time # in
+        health_status = await health_cache.get(app_name, db_pool.fetch_health_status, master_db_pool.fetch_health_status)
+        t2 = time.time() # in
         db_response_time.observe(t2-t1) #in
-        cur.close()
-        conn.close()
-        if not health_status:
-            number_of_db_errors.inc() #in
-            raise HTTPException(status_code=404, detail="App not found")
-        return JSONResponse(content=health_status)
     except Exception as e:
         number_of_db_errors.inc() #in
         raise HTTPException(status_code=500, detail=str(e))
+    if not health_status:
+        number_of_db_errors.inc() #in
+        raise HTTPException(status_code=404, detail="App not found")
+    return JSONResponse(content=jsonable_encoder(health_status))
 
 
 if __name__ == "__main__":
     import uvicorn
-    start_http_server(6969)
     uvicorn.run(app, host="0.0.0.0", port=7001)
 
@@ -1,5 +1,5 @@
 from fastapi import FastAPI, HTTPException
-from kubernetes import client, config
+from kubernetes import client
 from kubernetes.client import *
 import psycopg2
 from psycopg2.extras import RealDictCursor
@@ -8,14 +8,103 @@ import psycopg2
 import base64
 import secrets
 import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import kube_clients
+from tracing import span
 # app = FastAPI()
 
-# Load Kubernetes configuration
-config.load_incluster_config()
+# Kubernetes configuration is loaded once per process by kube_clients
+IN_CLUSTER = True
+
+# Steps within a phase do not depend on each other and are created concurrently,
+# the StatefulSet and Service only go out once the config, secret and volume they use exist
+POSTGRES_PHASES = [["secret", "configmap", "pv", "pvc"], ["statefulset", "service"]]
+# Steps of deploy_postgresql in the order they run, progress is reported under these names
+POSTGRES_STEPS = [step for phase in POSTGRES_PHASES for step in phase]
+
+step_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="provision")
+
+def run_step(name, progress, create):
+    if progress is not None:
+        progress(name, "running", None)
+    t1 = time.time()
+    try:
+        with span("k8s.create", step=name):
+            create()
+    except Exception:
+        if progress is not None:
+            progress(name, "failed", round(time.time()-t1, 4))
+        raise
+    seconds = round(time.time()-t1, 4)
+    if progress is not None:
+        progress(name, "done", seconds)
+    return seconds
+
+def rollback(steps, created, timings, progress):
+    # Deletes what was created, in reverse order, so a retry does not run into conflicts
+    failures = []
+    for name in reversed(created):
+        try:
+            with span("k8s.delete", step=name):
+                steps[name][1]()
+        except client.exceptions.ApiException as e:
+            if e.status != 404:
+                failures.append(f"{name}: {e.reason}")
+                continue
+        except Exception as e:
+            failures.append(f"{name}: {str(e)}")
+            continue
+        if progress is not None:
+            progress(name, "rolled_back", timings.get(name))
+    return failures
+
+def provision(steps, progress=None, completed_steps=()):
+    # steps maps each step name to its (create, delete) calls. Steps finished by an
+    # earlier, interrupted run are not created again, but are rolled back with the rest.
+    t1 = time.time()
+    created = [name for name in POSTGRES_STEPS if name in completed_steps]
+    timings = {}
+    for phase in POSTGRES_PHASES:
+        futures = {name: step_executor.submit(contextvars.copy_context().run, run_step, name, progress, steps[name][0])
+                   for name in phase if name not in completed_steps}
+
+        # Every step of the phase is waited for, nothing is still being created during a rollback
+        errors = []
+        for name, future in futures.items():
+            try:
+                timings[name] = future.result()
+                created.append(name)
+            except client.exceptions.ApiException as e:
+                errors.append(f"{name}: ({e.status}) {e.reason}")
+            except Exception as e:
+                errors.append(f"{name}: {str(e)}")
+
+        if errors:
+            failures = rollback(steps, created, timings, progress)
+            message = "; ".join(errors)
+            if failures:
+                message += "; rollback failed for " + ", ".join(failures)
+            raise Exception(message)
+
+    return {
+        "seconds": round(time.time()-t1, 4),
+        "steps": [{"step": name,
+                   "status": "created" if name in timings else "skipped",
+                   "seconds": timings.get(name)}
+                  for name in POSTGRES_STEPS]
+    }
 
 #@app.post("/deploy-postgresql")
-def deploy_postgresql(appname, cpu, memory, external):
+def deploy_postgresql(appname, cpu, memory, external, progress=None, completed_steps=(), namespace="default", kube=None):
     try:
+        # Shared API clients, the config is not re-read on every call. Another cluster's
+        # clients can be passed in.
+        kube = kube or kube_clients.get(IN_CLUSTER)
+        k8s_core_v1 = kube.core_v1
+        k8s_apps_v1 = kube.apps_v1
+        steps = {}
 
 #################################################### SECRET #############################################
         username = secrets.token_hex(4)  # Generate a random hexadecimal username
@@ -44,11 +133,10 @@ def deploy_postgresql(appname, cpu, memory, external):
             data= secret_data
         )
 
-        # Create the Secret
-        k8s_core_v1 = client.CoreV1Api()
-        k8s_core_v1.create_namespaced_secret(
-            namespace="default",
-            body=secret
+        # Create the Secret, deleted again if provisioning fails
+        steps["secret"] = (
+            partial(k8s_core_v1.create_namespaced_secret, namespace=namespace, body=secret),
+            partial(k8s_core_v1.delete_namespaced_secret, f"{appname}-secret", namespace)
         )
 ############################################ ConfigMap ##################################################
         # Define the ConfigMap object
@@ -78,11 +166,10 @@ def deploy_postgresql(appname, cpu, memory, external):
             }
         )
 
-        # Create the ConfigMap
-        k8s_core_v1 = client.CoreV1Api()
-        k8s_core_v1.create_namespaced_config_map(
-            namespace="default",
-            body=config_map
+        # Create the ConfigMap, deleted again if provisioning fails
+        steps["configmap"] = (
+            partial(k8s_core_v1.create_namespaced_config_map, namespace=namespace, body=config_map),
+            partial(k8s_core_v1.delete_namespaced_config_map, f"{appname}-config", namespace)
         )
 ############################################## PV & PVC #################################################
 
@@ -98,10 +185,10 @@ def deploy_postgresql(appname, cpu, memory, external):
             )
         )
 
-        # Create the PV
-        k8s_core_v1 = client.CoreV1Api()
-        k8s_core_v1.create_persistent_volume(
-            body=persistent_volume
+        # Create the PV, deleted again if provisioning fails
+        steps["pv"] = (
+            partial(k8s_core_v1.create_persistent_volume, body=persistent_volume),
+            partial(k8s_core_v1.delete_persistent_volume, f"{appname}-pv")
         )
 
         # Define the PersistentVolumeClaim object
@@ -117,11 +204,10 @@ def deploy_postgresql(appname, cpu, memory, external):
             )
         )
 
-        # Create the PVC
-        k8s_core_v1 = client.CoreV1Api()
-        k8s_core_v1.create_namespaced_persistent_volume_claim(
-            namespace='default',
-            body=persistent_volume_claim
+        # Create the PVC, deleted again if provisioning fails
+        steps["pvc"] = (
+            partial(k8s_core_v1.create_namespaced_persistent_volume_claim, namespace=namespace, body=persistent_volume_claim),
+            partial(k8s_core_v1.delete_namespaced_persistent_volume_claim, f"{appname}-pvc", namespace)
         )
 
 ########################################################################################################
@@ -155,11 +241,10 @@ def deploy_postgresql(appname, cpu, memory, external):
             )
         )
 
-        # Create the StatefulSet
-        k8s_apps_v1 = client.AppsV1Api()
-        k8s_apps_v1.create_namespaced_stateful_set(
-            namespace="default",
-            body=statefulset
+        # Create the StatefulSet, deleted again if provisioning fails
+        steps["statefulset"] = (
+            partial(k8s_apps_v1.create_namespaced_stateful_set, namespace=namespace, body=statefulset),
+            partial(k8s_apps_v1.delete_namespaced_stateful_set, appname, namespace)
         )
         if (external == False):
         # Define the PostgreSQL Service
@@ -194,34 +279,32 @@ def deploy_postgresql(appname, cpu, memory, external):
         )
 
 
-        # Create the Service
-        k8s_core_v1 = client.CoreV1Api()
-        k8s_core_v1.create_namespaced_service(
-            namespace="default",
-            body=service
+        # Create the Service, deleted again if provisioning fails
+        steps["service"] = (
+            partial(k8s_core_v1.create_namespaced_service, namespace=namespace, body=service),
+            partial(k8s_core_v1.delete_namespaced_service, f"{appname}-service", namespace)
         )
 
         # # checking for external access
         # if (external == True):
         #     initialize_postgresql(appname, username)
 
-        return {"message": "PostgreSQL StatefulSet and Service and Secret created successfully"}
+        # Create everything, or nothing if one of the steps fails
+        timings = provision(steps, progress, completed_steps)
+        return {"message": "PostgreSQL StatefulSet and Service and Secret created successfully", **timings}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 def initialize_postgresql(appname, username):
     try:
-        # Load Kubernetes configuration
-        config.load_kube_config()
-
         # Specify the namespace and pod name (adjust these according to your deployment)
         namespace = "default"
         pod_name = f"{appname}-0"  # Adjust this according to your StatefulSet pod naming convention
         container = appname
 
-        # Create an instance of the CoreV1Api
-        api_instance = client.CoreV1Api()
+        # Shared CoreV1Api instance
+        api_instance = kube_clients.get(IN_CLUSTER).core_v1
 
         # Command to execute inside the pod (psql command)
         command = [f'psql', '-U', {username}, '-d', 'my_database']  # Replace with your PostgreSQL username and database
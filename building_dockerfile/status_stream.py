@@ -0,0 +1,141 @@
+import asyncio
+import json
+import os
+from collections import deque
+from prometheus_client import Counter, Gauge
+from deployment_status import build_status, group_pods, grouped_statuses
+
+# Events kept for clients that reconnect with Last-Event-ID, older ones get a new snapshot
+STATUS_STREAM_HISTORY = int(os.getenv("STATUS_STREAM_HISTORY", "1000"))
+# Events buffered per client, a client that falls this far behind is resynced
+STATUS_STREAM_CLIENT_BUFFER = int(os.getenv("STATUS_STREAM_CLIENT_BUFFER", "100"))
+# A comment is sent after this many idle seconds so proxies keep the connection open
+KEEPALIVE_SECONDS = 15
+
+SNAPSHOT = object()
+
+status_stream_subscribers = Gauge("status_stream_subscribers", "clients connected to the status event stream")
+
+status_stream_events = Counter("status_stream_events", "status deltas published to the event stream")
+
+status_stream_resyncs = Counter("status_stream_resyncs", "snapshots sent to clients", ["reason"])
+
+
+def sse_message(event, data, event_id=None):
+    message = f"event: {event}\ndata: {data}\n\n"
+    if event_id is not None:
+        message = f"id: {event_id}\n" + message
+    return message
+
+
+class StatusBroadcaster:
+    # Turns the events of the deployment and pod informers into status deltas and fans
+    # them out to every subscriber. Each delta is built and encoded once, whatever the
+    # number of clients, and the event id is the resourceVersion of the changed object.
+
+    def __init__(self, deployments, pods, namespace="default"):
+        self.deployments = deployments
+        self.pods = pods
+        self.namespace = namespace
+        self._history = deque(maxlen=STATUS_STREAM_HISTORY)
+        self._subscribers = set()
+        self._loop = None
+        status_stream_subscribers.set_function(lambda: len(self._subscribers))
+
+    def start(self):
+        # Informer listeners run on the informer threads, deltas are built on the loop
+        self._loop = asyncio.get_running_loop()
+        self.deployments.add_listener(
+            lambda event_type, obj: self._loop.call_soon_threadsafe(self._on_deployment, event_type, obj))
+        self.pods.add_listener(
+            lambda event_type, obj: self._loop.call_soon_threadsafe(self._on_pod, event_type, obj))
+
+    def snapshot(self):
+        deployments = self.deployments.list(self.namespace)
+        grouped = group_pods(deployments, self.pods.list(self.namespace))
+        # Resuming from the snapshot continues with the events published after it
+        event_id = self._history[-1][0] if self._history else self.deployments.freshness()["resource_version"]
+        return sse_message("snapshot", json.dumps(list(grouped_statuses(deployments, grouped))), event_id)
+
+    async def subscribe(self, last_event_id=None):
+        # Replays what the client missed if it is still in the history, otherwise starts
+        # with a snapshot of every deployment
+        queue = asyncio.Queue(maxsize=STATUS_STREAM_CLIENT_BUFFER)
+        replay = self._since(last_event_id)
+        if replay is None:
+            status_stream_resyncs.labels("connect" if last_event_id is None else "expired").inc()
+            queue.put_nowait(SNAPSHOT)
+        else:
+            for message in replay[-STATUS_STREAM_CLIENT_BUFFER:]:
+                queue.put_nowait(message)
+            if len(replay) > STATUS_STREAM_CLIENT_BUFFER:
+                self._resync(queue, "slow_client")
+        self._subscribers.add(queue)
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield self.snapshot() if message is SNAPSHOT else message
+        finally:
+            self._subscribers.discard(queue)
+
+    ########################################## internals ##########################################
+
+    def _since(self, last_event_id):
+        if last_event_id is None:
+            return None
+        for i, (event_id, _) in enumerate(self._history):
+            if event_id == last_event_id:
+                return [message for _, message in list(self._history)[i + 1:]]
+        return None
+
+    def _resync(self, queue, reason):
+        # The client gets a single snapshot in place of everything still queued for it
+        status_stream_resyncs.labels(reason).inc()
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(SNAPSHOT)
+
+    def _publish(self, event_id, message):
+        status_stream_events.inc()
+        self._history.append((event_id, message))
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                self._resync(queue, "slow_client")
+
+    def _reset(self):
+        # Events were missed during a relist, nobody can resume from before it
+        self._history.clear()
+        for queue in self._subscribers:
+            self._resync(queue, "relist")
+
+    def _publish_status(self, app, event_id):
+        deployment = self.deployments.get(self.namespace, app)
+        if deployment is None:
+            return
+        status = build_status(deployment, self.pods.by_app(self.namespace, app))
+        self._publish(event_id, sse_message("status", json.dumps(status), event_id))
+
+    def _on_deployment(self, event_type, deployment):
+        if event_type == "RELIST":
+            self._reset()
+            return
+        event_id = deployment.metadata.resource_version
+        if event_type == "DELETED":
+            data = json.dumps({"deployment": {"name": deployment.metadata.name}})
+            self._publish(event_id, sse_message("deleted", data, event_id))
+            return
+        self._publish_status(deployment.metadata.name, event_id)
+
+    def _on_pod(self, event_type, pod):
+        if event_type == "RELIST":
+            self._reset()
+            return
+        app = (pod.metadata.labels or {}).get("app")
+        if app is not None:
+            self._publish_status(app, pod.metadata.resource_version)
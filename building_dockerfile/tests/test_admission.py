@@ -0,0 +1,263 @@
+# Deterministic checks of request coalescing and admission control. Nothing is timed
+# against wall clock load: computations and admitted requests block on events the
+# checks release, so every run sees the same interleaving.
+#
+#   python -m pytest tests
+#   python tests/test_admission.py                    # without pytest, exits 1 if a check fails
+import asyncio
+import os
+import sys
+import traceback
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+from prometheus_client import REGISTRY
+from admission import RETRY_AFTER_SECONDS, AdmissionMiddleware, ConcurrencyLimiter, Overloaded, SingleFlight
+from instrumentation import MetricsMiddleware
+
+
+async def settle():
+    # Lets every runnable task reach its next await
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+########################################## single flight ##########################################
+
+async def check_coalescing():
+    flights = SingleFlight("check")
+    release = asyncio.Event()
+    runs = []
+
+    async def compute(key):
+        runs.append(key)
+        await release.wait()
+        return f"result-{key}-{len(runs)}"
+
+    callers = [asyncio.ensure_future(flights.do("a", compute, "a")) for _ in range(10)]
+    other = asyncio.ensure_future(flights.do("b", compute, "b"))
+    await settle()
+    assert runs == ["a", "b"], f"one computation per key expected, ran {runs}"
+    release.set()
+    results = await asyncio.gather(*callers)
+    assert results == ["result-a-2"] * 10, f"every caller gets the shared result, got {set(results)}"
+    assert await other == "result-b-2"
+
+    # Once finished the key is free, the next caller computes afresh
+    assert await flights.do("a", compute, "a") == "result-a-3"
+    assert runs == ["a", "b", "a"]
+
+
+async def check_caller_cancellation():
+    flights = SingleFlight("check")
+    release = asyncio.Event()
+
+    async def compute():
+        await release.wait()
+        return "done"
+
+    leaving = asyncio.ensure_future(flights.do("k", compute))
+    staying = asyncio.ensure_future(flights.do("k", compute))
+    await settle()
+    leaving.cancel()
+    await settle()
+    release.set()
+    assert await staying == "done", "a caller going away must not cancel the computation for the others"
+    assert leaving.cancelled()
+
+
+async def check_shared_failure():
+    flights = SingleFlight("check")
+    release = asyncio.Event()
+
+    async def compute():
+        await release.wait()
+        raise RuntimeError("apiserver down")
+
+    callers = [asyncio.ensure_future(flights.do("k", compute)) for _ in range(3)]
+    await settle()
+    release.set()
+    outcomes = await asyncio.gather(*callers, return_exceptions=True)
+    assert all(isinstance(outcome, RuntimeError) for outcome in outcomes), outcomes
+
+
+########################################## limiter ##########################################
+
+async def check_limiter():
+    limiter = ConcurrencyLimiter("/check-limiter", limit=1, max_queue=1, queue_timeout=0.05)
+
+    await limiter.acquire()
+    assert limiter.running == 1
+    queued = asyncio.ensure_future(limiter.acquire())
+    await settle()
+    assert limiter.waiting == 1, "with the slot taken the second request waits"
+
+    # The queue is full, the third is refused at once. Without a service time yet
+    # Retry-After is the configured default.
+    try:
+        await limiter.acquire()
+        raise AssertionError("expected 429 with a full queue")
+    except Overloaded as e:
+        assert e.status_code == 429, e.status_code
+        assert e.retry_after == RETRY_AFTER_SECONDS, e.retry_after
+
+    # The queued one never gets the slot and gives up after queue_timeout
+    try:
+        await queued
+        raise AssertionError("expected 503 after the queue timeout")
+    except Overloaded as e:
+        assert e.status_code == 503, e.status_code
+    assert limiter.waiting == 0
+
+    # Retry-After follows the queue depth and the average service time
+    limiter.release(4.0)
+    assert limiter.running == 0 and limiter.service_time == 4.0
+    assert limiter.retry_after() == 4
+    limiter.waiting = 2
+    assert limiter.retry_after() == 12
+    limiter.waiting = 0
+
+    # The released slot is taken again without waiting
+    await limiter.acquire()
+    limiter.release(4.0)
+
+
+########################################## middleware ##########################################
+
+async def call(app, path):
+    # Sends one GET through an ASGI app, returns the status and the response headers
+    scope = {"type": "http", "method": "GET", "path": path, "headers": [], "query_string": b""}
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    start = next(message for message in messages if message["type"] == "http.response.start")
+    return start["status"], {key.decode(): value.decode() for key, value in start["headers"]}
+
+
+def histogram_count(route, status):
+    return REGISTRY.get_sample_value("http_request_duration_seconds_count",
+                                     {"method": "GET", "route": route, "status": status}) or 0
+
+
+async def check_middleware():
+    endpoint = "/check-middleware"
+    release = asyncio.Event()
+
+    async def slow_app(scope, receive, send):
+        await release.wait()
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"{}"})
+
+    limiter = ConcurrencyLimiter(endpoint, limit=1, max_queue=1, queue_timeout=0.05)
+    app = MetricsMiddleware(AdmissionMiddleware(slow_app, limiters=[limiter]))
+    shed_before = histogram_count(endpoint, "429"), histogram_count(endpoint, "503")
+
+    admitted = asyncio.ensure_future(call(app, endpoint))
+    await settle()
+    queued = asyncio.ensure_future(call(app, endpoint))
+    await settle()
+    status, headers = await call(app, endpoint)
+    assert status == 429, status
+    assert headers.get("retry-after") == str(RETRY_AFTER_SECONDS), headers
+
+    status, headers = await queued
+    assert status == 503, status
+    assert "retry-after" in headers, headers
+
+    release.set()
+    assert (await admitted)[0] == 200
+    # Shed requests are counted under their endpoint, not as unmatched
+    assert histogram_count(endpoint, "429") == shed_before[0] + 1
+    assert histogram_count(endpoint, "503") == shed_before[1] + 1
+
+    # Paths without a limiter go straight through
+    assert (await call(app, "/not-limited"))[0] == 200
+
+
+async def check_early_release():
+    endpoint = "/check-early-release"
+    applied = asyncio.Event()
+    rolled_out = asyncio.Event()
+
+    async def waiting_app(scope, receive, send):
+        # Gives the slot back after the apply, then waits for the rollout
+        await applied.wait()
+        scope["admission_release"]()
+        await rolled_out.wait()
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"{}"})
+
+    limiter = ConcurrencyLimiter(endpoint, limit=1, max_queue=0)
+    app = AdmissionMiddleware(waiting_app, limiters=[limiter])
+
+    waiting = asyncio.ensure_future(call(app, endpoint))
+    await settle()
+    assert limiter.running == 1
+    applied.set()
+    await settle()
+    assert limiter.running == 0, "the slot is free while the rollout is awaited"
+    service_time = limiter.service_time
+
+    # The next request is admitted although the first is still waiting
+    other = asyncio.ensure_future(call(app, endpoint))
+    await asyncio.sleep(0.05)
+    rolled_out.set()
+    assert (await waiting)[0] == 200
+    assert (await other)[0] == 200
+    assert limiter.running == 0
+    assert service_time < 0.05, "the wait is not part of the service time"
+
+
+CHECKS = [check_coalescing, check_caller_cancellation, check_shared_failure, check_limiter, check_middleware,
+          check_early_release]
+
+
+# pytest entry points, one event loop per check
+
+def test_coalescing():
+    asyncio.run(check_coalescing())
+
+
+def test_caller_cancellation():
+    asyncio.run(check_caller_cancellation())
+
+
+def test_shared_failure():
+    asyncio.run(check_shared_failure())
+
+
+def test_limiter():
+    asyncio.run(check_limiter())
+
+
+def test_middleware():
+    asyncio.run(check_middleware())
+
+
+def test_early_release():
+    asyncio.run(check_early_release())
+
+
+def main():
+    failed = 0
+    for check in CHECKS:
+        try:
+            asyncio.run(check())
+            print(f"ok      {check.__name__}")
+        except Exception:
+            failed += 1
+            print(f"FAILED  {check.__name__}")
+            traceback.print_exc()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
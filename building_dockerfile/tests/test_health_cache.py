@@ -0,0 +1,76 @@
+# Checks that a health cache miss right after a notification is read from the master
+#
+#   python -m pytest tests
+import asyncio
+import os
+import sys
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+from health_cache import HealthCache
+
+
+class Database:
+    # Rows of one app on the master and on a slave that has not replayed the last change
+
+    def __init__(self):
+        self.master = [{"app_name": "app", "success_count": 1}]
+        self.slave = [{"app_name": "app", "success_count": 0}]
+        self.reads = []
+
+    async def from_slave(self, app_name):
+        self.reads.append("slave")
+        return self.slave
+
+    async def from_master(self, app_name):
+        self.reads.append("master")
+        return self.master
+
+
+def listening_cache():
+    cache = HealthCache()
+    cache.listening = True
+    return cache
+
+
+async def check_notified_miss_reads_master():
+    db = Database()
+    cache = listening_cache()
+    assert await cache.get("app", db.from_slave, db.from_master) == db.slave
+    assert await cache.get("app", db.from_slave, db.from_master) == db.slave
+    assert db.reads == ["slave"], "the second lookup is a cache hit"
+
+    # A change is announced, the slave still has the old row
+    cache.invalidate("app")
+    assert await cache.get("app", db.from_slave, db.from_master) == db.master
+    assert await cache.get("app", db.from_slave, db.from_master) == db.master
+    assert db.reads == ["slave", "master"], "the master row is cached, not the lagging slave row"
+
+
+async def check_notification_during_load():
+    db = Database()
+    cache = listening_cache()
+    cache.invalidate("app")
+    release = asyncio.Event()
+
+    async def slow_master(app_name):
+        await release.wait()
+        return db.master
+
+    load = asyncio.ensure_future(cache.get("app", db.from_slave, slow_master))
+    await asyncio.sleep(0)
+    # Another change lands while the first one is being read, that read may predate it
+    cache.invalidate("app")
+    release.set()
+    assert await load == db.master
+    await cache.get("app", db.from_slave, db.from_master)
+    assert db.reads == ["master"], "the raced load was not cached and the next one still goes to the master"
+
+
+def test_notified_miss_reads_master():
+    asyncio.run(check_notified_miss_reads_master())
+
+
+def test_notification_during_load():
+    asyncio.run(check_notification_during_load())
@@ -0,0 +1,99 @@
+# Checks that rollout waits in the cached namespace are answered from the informer and
+# do not take a stale copy of the Deployment for the applied one
+#
+#   python -m pytest tests
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+from rollout import CachedRollouts, deployment_rollout, wait_for_deployment
+
+
+def deployment(generation, observed_generation, available):
+    return SimpleNamespace(
+        metadata=SimpleNamespace(name="web", namespace="default", generation=generation),
+        spec=SimpleNamespace(replicas=2),
+        status=SimpleNamespace(observed_generation=observed_generation, conditions=None, replicas=2,
+                               updated_replicas=2, available_replicas=available)
+    )
+
+
+class Informer:
+    # Holds the objects and calls the listeners on the loop, as call_soon_threadsafe would
+
+    def __init__(self):
+        self.objects = {}
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def get(self, namespace, name):
+        return self.objects.get((namespace, name))
+
+    def put(self, obj):
+        self.objects[(obj.metadata.namespace, obj.metadata.name)] = obj
+        self._notify("MODIFIED", obj)
+
+    def delete(self, obj):
+        self.objects.pop((obj.metadata.namespace, obj.metadata.name), None)
+        self._notify("DELETED", obj)
+
+    def _notify(self, event_type, obj):
+        for listener in self.listeners:
+            listener(event_type, obj)
+
+
+async def settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+async def check_waits_for_applied_generation():
+    informer = Informer()
+    # The copy from before the apply is fully rolled out
+    informer.objects[("default", "web")] = deployment(1, 1, 2)
+    rollouts = CachedRollouts(informer, deployment_rollout)
+    rollouts.start()
+
+    waiter = asyncio.ensure_future(wait_for_deployment(None, "default", "web", 5, rollouts, min_generation=2))
+    await settle()
+    assert not waiter.done(), "the stale generation 1 is not taken for the applied generation 2"
+
+    informer.put(deployment(2, 2, 1))
+    await settle()
+    assert not waiter.done(), "one of two replicas is available"
+
+    informer.put(deployment(2, 2, 2))
+    result = await waiter
+    assert result["status"] == "ready"
+    assert rollouts._waiters == {}
+
+
+async def check_deleted_and_timeout():
+    informer = Informer()
+    informer.objects[("default", "web")] = deployment(1, 1, 0)
+    rollouts = CachedRollouts(informer, deployment_rollout)
+    rollouts.start()
+
+    waiter = asyncio.ensure_future(wait_for_deployment(None, "default", "web", 5, rollouts))
+    await settle()
+    informer.delete(deployment(1, 1, 0))
+    assert (await waiter)["status"] == "failed"
+
+    informer.objects[("default", "web")] = deployment(1, 1, 0)
+    result = await wait_for_deployment(None, "default", "web", 0.05, rollouts)
+    assert result["status"] == "timeout"
+    assert rollouts._waiters == {}, "a timed out waiter is forgotten"
+
+
+def test_waits_for_applied_generation():
+    asyncio.run(check_waits_for_applied_generation())
+
+
+def test_deleted_and_timeout():
+    asyncio.run(check_deleted_and_timeout())
@@ -0,0 +1,134 @@
+import json
+import logging
+import os
+import queue
+import secrets
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Finished spans are appended to this file as JSON lines, an empty value turns the file off
+TRACE_FILE = os.getenv("TRACE_FILE", "kaas-api-traces.jsonl")
+TRACE_FILE_MAX_BYTES = int(os.getenv("TRACE_FILE_MAX_BYTES", str(10 * 1024 * 1024)))
+TRACE_FILE_BACKUPS = int(os.getenv("TRACE_FILE_BACKUPS", "5"))
+
+# (trace, id of the innermost open span) of the request or job being handled
+_current = ContextVar("kaas_trace", default=None)
+
+trace_logger = logging.getLogger("kaas.trace")
+trace_logger.propagate = False
+trace_logger.setLevel(logging.INFO)
+
+if TRACE_FILE:
+    # Spans are written by a listener thread, the request only puts them on a queue
+    _trace_queue = queue.SimpleQueue()
+    trace_logger.addHandler(QueueHandler(_trace_queue))
+    _trace_listener = QueueListener(
+        _trace_queue, RotatingFileHandler(TRACE_FILE, maxBytes=TRACE_FILE_MAX_BYTES, backupCount=TRACE_FILE_BACKUPS)
+    )
+    _trace_listener.start()
+
+
+class Trace:
+    # Spans of one request or job. Records follow the OTLP span fields so a collector
+    # reading the file can map them one to one.
+
+    def __init__(self):
+        self.trace_id = secrets.token_hex(16)
+        self.started = time.perf_counter()
+        self.spans = []
+
+
+@contextmanager
+def span(name, **attributes):
+    # Times the block as a child of the current span. Outside of a trace it does nothing.
+    # Yields the attributes so the block can add to them.
+    current = _current.get()
+    if current is None:
+        yield attributes
+        return
+
+    trace, parent_id = current
+    span_id = secrets.token_hex(8)
+    token = _current.set((trace, span_id))
+    start_ns = time.time_ns()
+    t1 = time.perf_counter()
+    status = "ok"
+    try:
+        yield attributes
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        t2 = time.perf_counter()
+        _current.reset(token)
+        record = {
+            "trace_id": trace.trace_id,
+            "span_id": span_id,
+            "parent_span_id": parent_id,
+            "name": name,
+            "start_time_unix_nano": start_ns,
+            "end_time_unix_nano": start_ns + int((t2-t1) * 1e9),
+            "duration_ms": round((t2-t1) * 1000, 3),
+            "status": status,
+            "attributes": attributes
+        }
+        trace.spans.append(record)
+        if TRACE_FILE:
+            trace_logger.info(json.dumps(record, default=str))
+
+
+@contextmanager
+def start_trace(name, **attributes):
+    # Starts a new trace whose root span covers the block
+    token = _current.set((Trace(), None))
+    try:
+        with span(name, **attributes) as root_attributes:
+            yield _current.get()[0], root_attributes
+    finally:
+        _current.reset(token)
+
+
+def server_timing(trace):
+    # One Server-Timing entry per span name, calls made concurrently add up
+    totals = {}
+    for record in trace.spans:
+        if record["parent_span_id"] is None:
+            continue
+        total = totals.setdefault(record["name"], [0.0, 0])
+        total[0] += record["duration_ms"]
+        total[1] += 1
+    entries = [f'{name};dur={ms:.1f};desc="{count} calls"' for name, (ms, count) in totals.items()]
+    entries.append(f"total;dur={(time.perf_counter() - trace.started) * 1000:.1f}")
+    return ", ".join(entries)
+
+
+class TracingMiddleware:
+    # Opens a trace per request and reports its spans in the Server-Timing header.
+    # Only spans that finished before the response started can be in the header,
+    # everything ends up in the trace file.
+
+    def __init__(self, app, skip_paths=("/metrics",)):
+        self.app = app
+        self.skip_paths = skip_paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.skip_paths:
+            await self.app(scope, receive, send)
+            return
+
+        with start_trace("http.request", method=scope["method"], path=scope["path"]) as (trace, attributes):
+            async def send_with_timing(message):
+                if message["type"] == "http.response.start":
+                    attributes["status"] = message["status"]
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", server_timing(trace).encode()))
+                    message = {**message, "headers": headers}
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_timing)
+            finally:
+                route = scope.get("route")
+                attributes["route"] = route.path if route is not None else None
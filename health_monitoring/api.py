@@ -1,33 +1,58 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from db_pool import MASTER_DB_HOST, MASTER_DB_POOL_MAX_SIZE, DBPool
+from health_cache import HealthCache
+from health_history import HOUR_ROLLUP_RETENTION_DAYS
 
 app = FastAPI()
 
-def get_db_connection():
-    conn = psycopg2.connect(
-        host="postgresql-slave.default.svc.cluster.local",  # Ensure this matches your PostgreSQL slave service name
-        database="yourdatabase",
-        user="mydbuser",
-        password="mypassword"
-    )
-    return conn
+# Pooled connections to the PostgreSQL slave, opened at startup
+db_pool = DBPool()
+# The master, for the first read of an app after a change was announced
+master_db_pool = DBPool(MASTER_DB_HOST, min_size=1, max_size=MASTER_DB_POOL_MAX_SIZE, name="health-db-master")
+
+# health_status rows cached per app, invalidated through LISTEN/NOTIFY
+health_cache = HealthCache()
+
+@app.on_event("startup")
+async def open_db_pool():
+    await db_pool.open()
+    await master_db_pool.open()
+    health_cache.start()
+
+@app.on_event("shutdown")
+async def close_db_pool():
+    await health_cache.stop()
+    await db_pool.close()
+    await master_db_pool.close()
 
 @app.get('/health/{app_name}')
 async def get_health(app_name: str):
     try:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute('SELECT * FROM health_status WHERE app_name = %s', (app_name,))
-        health_status = cur.fetchall()
-        cur.close()
-        conn.close()
-        if not health_status:
-            raise HTTPException(status_code=404, detail="App not found")
-        return JSONResponse(content=health_status)
+        health_status = await health_cache.get(app_name, db_pool.fetch_health_status, master_db_pool.fetch_health_status)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if not health_status:
+        raise HTTPException(status_code=404, detail="App not found")
+    return JSONResponse(content=jsonable_encoder(health_status))
+
+@app.get('/health/{app_name}/uptime')
+async def get_uptime(app_name: str, window: int = Query(3600, ge=60, le=HOUR_ROLLUP_RETENTION_DAYS * 86400)):
+    # Uptime and latency percentiles over the last `window` seconds, read from the rollups
+    try:
+        uptime = await db_pool.fetch_uptime(app_name, window)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    if not uptime["probes"]:
+        raise HTTPException(status_code=404, detail="No probes recorded in this window")
+    return uptime
+
+# Pool and cache metrics, served on the API port like the KaaS API does
+@app.get('/metrics', include_in_schema=False)
+def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 if __name__ == '__main__':
     import uvicorn
@@ -0,0 +1,71 @@
+# Also in building_dockerfile/db_pool.py: each image is built from its own directory, so the
+# module is copied rather than shared. Keep the two in step.
+import os
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+from prometheus_client import Gauge
+from health_history import fetch_uptime
+
+# Connection settings of the PostgreSQL slave that holds health_status
+DB_HOST = os.getenv("DB_HOST", "postgresql-slave.default.svc.cluster.local")
+# The master, read only right after a change was announced and the slave may not have it yet
+MASTER_DB_HOST = os.getenv("MASTER_DB_HOST", "postgresql-master.default.svc.cluster.local")
+MASTER_DB_POOL_MAX_SIZE = int(os.getenv("MASTER_DB_POOL_MAX_SIZE", "2"))
+DB_NAME = os.getenv("DB_NAME", "yourdatabase")
+DB_USER = os.getenv("DB_USER", "mydbuser")
+DB_PASSWORD = os.getenv("DB_PASSWORD", "mypassword")
+
+# Pool sizing, a request waits at most DB_POOL_TIMEOUT seconds for a free connection
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+
+HEALTH_STATUS_QUERY = "SELECT * FROM health_status WHERE app_name = %s"
+
+db_pool_size = Gauge("db_pool_size", "connections currently managed by the pool", ["pool"])
+
+db_pool_available = Gauge("db_pool_available", "idle connections ready to be used", ["pool"])
+
+db_pool_requests_waiting = Gauge("db_pool_requests_waiting", "requests queued for a free connection", ["pool"])
+
+db_pool_max_size = Gauge("db_pool_max_size", "upper limit of the pool size", ["pool"])
+
+
+class DBPool:
+    # Async connection pool opened once at startup. Connections are checked before
+    # they are handed out and the health_status lookup runs as a prepared statement.
+
+    def __init__(self, host=DB_HOST, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE, timeout=DB_POOL_TIMEOUT,
+                 name="health-db"):
+        self.pool = AsyncConnectionPool(
+            f"host={host} dbname={DB_NAME} user={DB_USER} password={DB_PASSWORD}",
+            min_size=min_size,
+            max_size=max_size,
+            timeout=timeout,
+            open=False,
+            check=AsyncConnectionPool.check_connection,
+            kwargs={"row_factory": dict_row},
+            name=name
+        )
+
+        # Saturation metrics are read from the pool when Prometheus scrapes
+        db_pool_size.labels(name).set_function(lambda: self.pool.get_stats().get("pool_size", 0))
+        db_pool_available.labels(name).set_function(lambda: self.pool.get_stats().get("pool_available", 0))
+        db_pool_requests_waiting.labels(name).set_function(lambda: self.pool.get_stats().get("requests_waiting", 0))
+        db_pool_max_size.labels(name).set(max_size)
+
+    async def open(self):
+        # Does not wait for the first connections, the app can start while the DB is down
+        await self.pool.open(wait=False)
+
+    async def close(self):
+        await self.pool.close()
+
+    async def fetch_health_status(self, app_name):
+        async with self.pool.connection() as conn:
+            cur = await conn.execute(HEALTH_STATUS_QUERY, (app_name,), prepare=True)
+            return await cur.fetchall()
+
+    async def fetch_uptime(self, app_name, window_seconds):
+        async with self.pool.connection() as conn:
+            return await fetch_uptime(conn, app_name, window_seconds)
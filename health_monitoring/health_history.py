@@ -0,0 +1,145 @@
+import datetime
+import os
+
+# Upper bounds (ms) of the latency histogram kept in every rollup row, the last bucket is open ended
+LATENCY_BOUNDS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+# Raw events are kept for this many days, then whole partitions are dropped
+EVENTS_RETENTION_DAYS = int(os.getenv("HEALTH_EVENTS_RETENTION_DAYS", "7"))
+MINUTE_ROLLUP_RETENTION_DAYS = int(os.getenv("HEALTH_MINUTE_ROLLUP_RETENTION_DAYS", "2"))
+HOUR_ROLLUP_RETENTION_DAYS = int(os.getenv("HEALTH_HOUR_ROLLUP_RETENTION_DAYS", "90"))
+
+# Windows up to this length are answered from minute rollups, longer ones from hour rollups
+MINUTE_ROLLUP_MAX_WINDOW = 6 * 3600
+
+INSERT_EVENTS = """
+    INSERT INTO health_events (app_name, probed_at, ok, latency_ms)
+    SELECT app_name, now(), ok, latency_ms
+    FROM unnest(%s::text[], %s::boolean[], %s::real[]) AS r(app_name, ok, latency_ms)
+"""
+
+# Adds one cycle of probes to the rollup of the current minute or hour
+UPSERT_ROLLUP = """
+    INSERT INTO {table} AS r (app_name, bucket, probes, successes, latency_ms_sum, latency_buckets)
+    SELECT app_name, date_trunc('{unit}', now()), 1, CASE WHEN ok THEN 1 ELSE 0 END, latency_ms,
+           latency_buckets
+    FROM unnest(%s::text[], %s::boolean[], %s::real[], %s::int[]) AS e(app_name, ok, latency_ms, bucket_index)
+    CROSS JOIN LATERAL (
+        SELECT array_agg(CASE WHEN i = e.bucket_index THEN 1 ELSE 0 END ORDER BY i) AS latency_buckets
+        FROM generate_series(0, {last_bucket}) AS i
+    ) b
+    ON CONFLICT (app_name, bucket) DO UPDATE SET
+        probes = r.probes + EXCLUDED.probes,
+        successes = r.successes + EXCLUDED.successes,
+        latency_ms_sum = r.latency_ms_sum + EXCLUDED.latency_ms_sum,
+        latency_buckets = ARRAY(
+            SELECT a + b FROM unnest(r.latency_buckets, EXCLUDED.latency_buckets) AS t(a, b)
+        )
+"""
+
+SELECT_ROLLUPS = """
+    SELECT probes, successes, latency_ms_sum, latency_buckets
+    FROM {table}
+    WHERE app_name = %s AND bucket >= now() - make_interval(secs => %s)
+"""
+
+
+def latency_bucket(latency_ms):
+    for i, bound in enumerate(LATENCY_BOUNDS_MS):
+        if latency_ms <= bound:
+            return i
+    return len(LATENCY_BOUNDS_MS)
+
+
+def percentile(buckets, q):
+    # Estimates a percentile from histogram counts by interpolating inside the bucket
+    total = sum(buckets)
+    if total == 0:
+        return None
+    rank = q * total
+    seen = 0
+    for i, count in enumerate(buckets):
+        if count and seen + count >= rank:
+            lower = LATENCY_BOUNDS_MS[i - 1] if i > 0 else 0
+            if i == len(LATENCY_BOUNDS_MS):
+                return float(lower)
+            upper = LATENCY_BOUNDS_MS[i]
+            return lower + (upper - lower) * (rank - seen) / count
+        seen += count
+    return float(LATENCY_BOUNDS_MS[-1])
+
+
+def rollup_table(window_seconds):
+    return "health_rollup_minute" if window_seconds <= MINUTE_ROLLUP_MAX_WINDOW else "health_rollup_hour"
+
+
+def summarize(app_name, window_seconds, rows):
+    probes = sum(row["probes"] for row in rows)
+    successes = sum(row["successes"] for row in rows)
+    latency_ms_sum = sum(row["latency_ms_sum"] for row in rows)
+    buckets = [0] * (len(LATENCY_BOUNDS_MS) + 1)
+    for row in rows:
+        for i, count in enumerate(row["latency_buckets"]):
+            buckets[i] += count
+    return {
+        "app_name": app_name,
+        "window_seconds": window_seconds,
+        "source": rollup_table(window_seconds),
+        "probes": probes,
+        "successes": successes,
+        "uptime": successes / probes if probes else None,
+        "latency_ms": {
+            "mean": latency_ms_sum / probes if probes else None,
+            "p50": percentile(buckets, 0.50),
+            "p95": percentile(buckets, 0.95),
+            "p99": percentile(buckets, 0.99)
+        }
+    }
+
+
+async def fetch_uptime(conn, app_name, window_seconds):
+    cur = await conn.execute(SELECT_ROLLUPS.format(table=rollup_table(window_seconds)), (app_name, window_seconds))
+    return summarize(app_name, window_seconds, await cur.fetchall())
+
+
+def partition_name(day):
+    return f"health_events_{day:%Y%m%d}"
+
+
+async def maintain_partitions(conn, today=None):
+    # Creates today's and tomorrow's event partitions and drops those past retention,
+    # along with rollup rows that are past their own retention
+    today = today or datetime.datetime.now(datetime.timezone.utc).date()
+    for offset in (0, 1):
+        day = today + datetime.timedelta(days=offset)
+        await conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {partition_name(day)} PARTITION OF health_events "
+            f"FOR VALUES FROM ('{day} 00:00+00') TO ('{day + datetime.timedelta(days=1)} 00:00+00')"
+        )
+    cur = await conn.execute(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = 'health_events'"
+    )
+    oldest = partition_name(today - datetime.timedelta(days=EVENTS_RETENTION_DAYS))
+    for (name,) in await cur.fetchall():
+        if name < oldest:
+            await conn.execute(f"DROP TABLE IF EXISTS {name}")
+    await conn.execute(
+        "DELETE FROM health_rollup_minute WHERE bucket < now() - make_interval(days => %s)",
+        (MINUTE_ROLLUP_RETENTION_DAYS,)
+    )
+    await conn.execute(
+        "DELETE FROM health_rollup_hour WHERE bucket < now() - make_interval(days => %s)",
+        (HOUR_ROLLUP_RETENTION_DAYS,)
+    )
+
+
+async def record_events(conn, apps, oks, latencies_ms):
+    # Appends one cycle of probes as raw events and folds them into both rollups
+    buckets = [latency_bucket(latency) for latency in latencies_ms]
+    await conn.execute(INSERT_EVENTS, (apps, oks, latencies_ms))
+    for table, unit in (("health_rollup_minute", "minute"), ("health_rollup_hour", "hour")):
+        await conn.execute(
+            UPSERT_ROLLUP.format(table=table, unit=unit, last_bucket=len(LATENCY_BOUNDS_MS)),
+            (apps, oks, latencies_ms, buckets)
+        )
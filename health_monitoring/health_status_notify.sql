@@ -0,0 +1,16 @@
+-- Sends the app_name of every changed health_status row on the health_status_changed
+-- channel, the API uses it to drop that app from its health cache.
+-- Apply on the master: psql -U postgres -d yourdatabase -f health_status_notify.sql
+
+CREATE OR REPLACE FUNCTION notify_health_status_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('health_status_changed', COALESCE(NEW.app_name, OLD.app_name));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS health_status_changed ON health_status;
+
+CREATE TRIGGER health_status_changed
+AFTER INSERT OR UPDATE OR DELETE ON health_status
+FOR EACH ROW EXECUTE FUNCTION notify_health_status_changed();
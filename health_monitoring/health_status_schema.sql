@@ -0,0 +1,45 @@
+-- Table written by prober.py and read by api.py
+-- Apply on the master: psql -U postgres -d yourdatabase -f health_status_schema.sql
+
+CREATE TABLE IF NOT EXISTS health_status (
+    app_name TEXT PRIMARY KEY,
+    success_count BIGINT NOT NULL DEFAULT 0,
+    failure_count BIGINT NOT NULL DEFAULT 0,
+    last_success TIMESTAMPTZ,
+    last_failure TIMESTAMPTZ
+);
+
+-- Tables created before the prober existed may lack a key, its UPSERT needs one
+CREATE UNIQUE INDEX IF NOT EXISTS health_status_app_name ON health_status (app_name);
+
+-- Append-only probe results, one partition per UTC day created and dropped by prober.py
+CREATE TABLE IF NOT EXISTS health_events (
+    app_name TEXT NOT NULL,
+    probed_at TIMESTAMPTZ NOT NULL,
+    ok BOOLEAN NOT NULL,
+    latency_ms REAL NOT NULL
+) PARTITION BY RANGE (probed_at);
+
+CREATE INDEX IF NOT EXISTS health_events_app_name_probed_at ON health_events (app_name, probed_at);
+
+-- Per app rollups updated on every probe cycle, latency_buckets counts probes per
+-- histogram bucket as defined by LATENCY_BOUNDS_MS in health_history.py
+CREATE TABLE IF NOT EXISTS health_rollup_minute (
+    app_name TEXT NOT NULL,
+    bucket TIMESTAMPTZ NOT NULL,
+    probes INTEGER NOT NULL,
+    successes INTEGER NOT NULL,
+    latency_ms_sum DOUBLE PRECISION NOT NULL,
+    latency_buckets INTEGER[] NOT NULL,
+    PRIMARY KEY (app_name, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS health_rollup_hour (
+    app_name TEXT NOT NULL,
+    bucket TIMESTAMPTZ NOT NULL,
+    probes INTEGER NOT NULL,
+    successes INTEGER NOT NULL,
+    latency_ms_sum DOUBLE PRECISION NOT NULL,
+    latency_buckets INTEGER[] NOT NULL,
+    PRIMARY KEY (app_name, bucket)
+);
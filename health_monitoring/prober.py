@@ -0,0 +1,109 @@
+import asyncio
+import os
+import time
+import aiohttp
+import psycopg
+from kubernetes_asyncio import client, config
+from health_history import maintain_partitions, record_events
+
+# Probe every app labelled monitor=true once per PROBE_INTERVAL seconds
+PROBE_INTERVAL = float(os.getenv("PROBE_INTERVAL", "5"))
+PROBE_TIMEOUT = float(os.getenv("PROBE_TIMEOUT", "2"))
+PROBE_CONCURRENCY = int(os.getenv("PROBE_CONCURRENCY", "200"))
+PROBE_NAMESPACE = os.getenv("PROBE_NAMESPACE", "default")
+PROBE_LABEL_SELECTOR = "monitor=true"
+# Seconds between event partition and rollup retention runs
+MAINTENANCE_INTERVAL = 3600
+
+# Results are written to the master, the API reads them from the slave
+DB_HOST = os.getenv("DB_MASTER_HOST", "postgresql-master.default.svc.cluster.local")
+DB_NAME = os.getenv("DB_NAME", "yourdatabase")
+DB_USER = os.getenv("DB_USER", "mydbuser")
+DB_PASSWORD = os.getenv("DB_PASSWORD", "mypassword")
+
+# One statement per cycle, every probed app is inserted or has its counters bumped
+UPSERT_HEALTH_STATUS = """
+    INSERT INTO health_status AS h (app_name, success_count, failure_count, last_success, last_failure)
+    SELECT app_name,
+           CASE WHEN ok THEN 1 ELSE 0 END,
+           CASE WHEN ok THEN 0 ELSE 1 END,
+           CASE WHEN ok THEN now() END,
+           CASE WHEN ok THEN NULL ELSE now() END
+    FROM unnest(%s::text[], %s::boolean[]) AS r(app_name, ok)
+    ON CONFLICT (app_name) DO UPDATE SET
+        success_count = h.success_count + EXCLUDED.success_count,
+        failure_count = h.failure_count + EXCLUDED.failure_count,
+        last_success = COALESCE(EXCLUDED.last_success, h.last_success),
+        last_failure = COALESCE(EXCLUDED.last_failure, h.last_failure)
+"""
+
+
+async def monitored_apps(core_v1):
+    pods = await core_v1.list_namespaced_pod(PROBE_NAMESPACE, label_selector=PROBE_LABEL_SELECTOR)
+    return sorted({pod.metadata.labels["app"] for pod in pods.items if "app" in (pod.metadata.labels or {})})
+
+
+async def probe(session, semaphore, app):
+    async with semaphore:
+        t1 = time.monotonic()
+        try:
+            async with session.get(f"http://{app}/healthz") as response:
+                ok = response.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            ok = False
+        return app, ok, time.monotonic() - t1
+
+
+async def write_results(conn, results):
+    apps = [app for app, _, _ in results]
+    oks = [ok for _, ok, _ in results]
+    latencies_ms = [seconds * 1000 for _, _, seconds in results]
+    async with conn.transaction():
+        await conn.execute(UPSERT_HEALTH_STATUS, (apps, oks))
+        await record_events(conn, apps, oks, latencies_ms)
+
+
+async def connect_db():
+    return await psycopg.AsyncConnection.connect(
+        f"host={DB_HOST} dbname={DB_NAME} user={DB_USER} password={DB_PASSWORD}"
+    )
+
+
+async def run():
+    if "KUBERNETES_SERVICE_HOST" in os.environ:
+        config.load_incluster_config()
+    else:
+        await config.load_kube_config()
+
+    semaphore = asyncio.Semaphore(PROBE_CONCURRENCY)
+    timeout = aiohttp.ClientTimeout(total=PROBE_TIMEOUT)
+    conn = None
+    last_maintenance = None
+    async with client.ApiClient() as api_client, \
+            aiohttp.ClientSession(timeout=timeout, connector=aiohttp.TCPConnector(limit=PROBE_CONCURRENCY)) as session:
+        core_v1 = client.CoreV1Api(api_client)
+        while True:
+            t1 = time.monotonic()
+            try:
+                apps = await monitored_apps(core_v1)
+                results = await asyncio.gather(*(probe(session, semaphore, app) for app in apps))
+                if conn is None or conn.closed:
+                    conn = await connect_db()
+                if last_maintenance is None or t1 - last_maintenance >= MAINTENANCE_INTERVAL:
+                    async with conn.transaction():
+                        await maintain_partitions(conn)
+                    last_maintenance = t1
+                if results:
+                    await write_results(conn, results)
+                failed = sum(1 for _, ok, _ in results if not ok)
+                print(f"probed {len(results)} apps, {failed} failed, in {time.monotonic() - t1:.2f}s")
+            except Exception as e:
+                print(f"probe cycle failed: {str(e)}")
+                if conn is not None:
+                    await conn.close()
+                    conn = None
+            await asyncio.sleep(max(0, PROBE_INTERVAL - (time.monotonic() - t1)))
+
+
+if __name__ == '__main__':
+    asyncio.run(run())